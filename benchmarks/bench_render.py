@@ -0,0 +1,209 @@
+"""
+Render benchmarks
+
+Renders a corpus of synthetic documents into HTMLScrolledText and reports, for
+each document, the wall time, the peak Python memory, the number of Tk tags and
+fonts created and the number of Tcl calls made by the widget. The peak memory is
+traced in a separate render, the timed ones run untraced. Results are printed as
+JSON, so they can be compared across versions.
+
+Needs a display, on a headless machine run it under Xvfb:
+
+    xvfb-run python benchmarks/bench_render.py --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import tkinter as tk
+from tkinter import font
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tkhtmlview import VERSION, HTMLScrolledText  # noqa: E402
+
+
+# __________________________________________________________________________________________________
+# corpus
+def long_paragraphs(count=2000):
+    # ------------------------------------------------------------------------------------------
+    sentence = "Lorem ipsum <b>dolor</b> sit amet, <i>consectetur</i> adipiscing elit. "
+    return "".join(f"<p>{i} {sentence * 8}</p>" for i in range(count))
+
+
+def deep_nesting(depth=200, repeat=20):
+    # ------------------------------------------------------------------------------------------
+    tags = ("div", "span", "b", "i", "u", "em", "strong")
+    opened = "".join(
+        f'<{tags[i % len(tags)]} style="color: #{i % 256:02x}0000">' for i in range(depth)
+    )
+    closed = "".join(f"</{tags[i % len(tags)]}>" for i in reversed(range(depth)))
+    return "".join(f"{opened}level {i}{closed}" for i in range(repeat))
+
+
+def big_table(rows=2000, columns=6):
+    # ------------------------------------------------------------------------------------------
+    header = "".join(f"<th>Column {c}</th>" for c in range(columns))
+    body = "".join(
+        "<tr>" + "".join(f"<td>cell {r}.{c}</td>" for c in range(columns)) + "</tr>"
+        for r in range(rows)
+    )
+    return f"<table><tr>{header}</tr>{body}</table>"
+
+
+def many_links(count=3000):
+    # ------------------------------------------------------------------------------------------
+    return "<ul>" + "".join(
+        f'<li><a href="https://example.com/page/{i}">link {i}</a></li>' for i in range(count)
+    ) + "</ul>"
+
+
+def many_images(directory, count=300):
+    # ------------------------------------------------------------------------------------------
+    paths = []
+    for i in range(10):
+        path = os.path.join(directory, f"image{i}.png")
+        Image.new("RGB", (64 + i, 48), (i * 20, 100, 200)).save(path)
+        paths.append(path)
+    return "".join(
+        f'<p>image {i} <img src="{paths[i % len(paths)]}" width="{32 + i % 3}"></p>'
+        for i in range(count)
+    )
+
+
+def corpus(directory):
+    # ------------------------------------------------------------------------------------------
+    return {
+        "long_paragraphs": long_paragraphs(),
+        "deep_nesting": deep_nesting(),
+        "big_table": big_table(),
+        "many_links": many_links(),
+        "many_images": many_images(directory),
+    }
+
+
+# __________________________________________________________________________________________________
+# instrumentation
+class TclCallCounter:
+    # ----------------------------------------------------------------------------------------------
+    """
+    Stand-in for a widget tk attribute, counting the calls to the Tcl interpreter
+    """
+
+    def __init__(self, tkapp):
+        # ------------------------------------------------------------------------------------------
+        self._tkapp = tkapp
+        self.calls = 0
+
+    def call(self, *args):
+        # ------------------------------------------------------------------------------------------
+        self.calls += 1
+        return self._tkapp.call(*args)
+
+    def __getattr__(self, name):
+        # ------------------------------------------------------------------------------------------
+        return getattr(self._tkapp, name)
+
+
+class CountingHTMLScrolledText(HTMLScrolledText):
+    # ----------------------------------------------------------------------------------------------
+    def __init__(self, *args, **kwargs):
+        # ------------------------------------------------------------------------------------------
+        super().__init__(*args, **kwargs)
+        self.tk = self.tcl_counter = TclCallCounter(self.tk)
+
+
+# __________________________________________________________________________________________________
+# benchmark
+def render(root, html, trace_memory=False):
+    # ------------------------------------------------------------------------------------------
+    """
+    Render html into a new widget, (wall time, peak traced memory, widget counts).
+    Tracing slows allocations down, so a traced render is not timed.
+    """
+    widget = CountingHTMLScrolledText(root)
+    widget.pack(fill="both", expand=True)
+    root.update()
+
+    fonts_before = len(font.names(root))
+    peak_memory = None
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    widget.set_html(html)
+    widget.update_idletasks()
+    elapsed = time.perf_counter() - start
+    if trace_memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    counts = {
+        "tags": len(widget.tag_names()),
+        "fonts": len(font.names(root)) - fonts_before,
+        "tcl_calls": widget.tcl_counter.calls,
+    }
+    # the frame holds the text and its scrollbar, later renders get the same size
+    widget.frame.destroy()
+    return elapsed, peak_memory, counts
+
+
+def bench(root, name, html, repeat):
+    # ------------------------------------------------------------------------------------------
+    times, counts = [], None
+    for _ in range(repeat):
+        elapsed, _, counts = render(root, html)
+        times.append(elapsed)
+    _, peak_memory, _ = render(root, html, trace_memory=True)
+
+    times.sort()
+    return {
+        "name": name,
+        "html_bytes": len(html.encode()),
+        "peak_memory_bytes": peak_memory,
+        **counts,
+        "wall_time_s": times[len(times) // 2],
+        "wall_time_min_s": times[0],
+    }
+
+
+def main():
+    # ------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3, help="renders per document")
+    parser.add_argument("--only", nargs="*", help="names of the documents to render")
+    parser.add_argument("--output", help="JSON file, printed to stdout by default")
+    args = parser.parse_args()
+
+    root = tk.Tk()
+    root.geometry("800x600")
+    with tempfile.TemporaryDirectory() as directory:
+        results = [
+            bench(root, name, html, args.repeat)
+            for name, html in corpus(directory).items()
+            if not args.only or name in args.only
+        ]
+    root.destroy()
+
+    report = {
+        "tkhtmlview": VERSION,
+        "python": platform.python_version(),
+        "tk": tk.TkVersion,
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+On-disk HTTP cache tests, against a local stand-in HTTP server
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+from tkhtmlview import images
+
+
+class Handler(BaseHTTPRequestHandler):
+    # ----------------------------------------------------------------------------------------------
+    """
+    Serves /etag with an ETag and no freshness, /fresh with a max-age, /no-store
+    with no-store, and a 404 for any other path. The requests are logged by the
+    server as (path, If-None-Match).
+    """
+
+    BODY = b"image bytes"
+
+    def do_GET(self):
+        # ------------------------------------------------------------------------------------------
+        self.server.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.path == "/etag" and self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        headers = {
+            "/etag": {"ETag": '"v1"', "Cache-Control": "max-age=0"},
+            "/fresh": {"Cache-Control": "max-age=3600"},
+            "/no-store": {"Cache-Control": "no-store", "ETag": '"v1"'},
+        }.get(self.path)
+        if headers is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(self.BODY)))
+        self.end_headers()
+        self.wfile.write(self.BODY)
+
+    def log_message(self, *args):
+        # ------------------------------------------------------------------------------------------
+        pass
+
+
+@pytest.fixture
+def server():
+    # ------------------------------------------------------------------------------------------
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def url(server, tmp_path):
+    # ------------------------------------------------------------------------------------------
+    images.set_disk_cache(str(tmp_path))
+    yield lambda path: f"http://127.0.0.1:{server.server_port}{path}"
+    images.set_disk_cache(None)
+
+
+def test_revalidated_with_etag(server, url):
+    # ------------------------------------------------------------------------------------------
+    assert images.fetch_bytes(url("/etag")) == Handler.BODY
+    assert images.fetch_bytes(url("/etag")) == Handler.BODY
+    assert server.requests == [("/etag", None), ("/etag", '"v1"')]
+
+
+def test_fresh_hit_without_network(server, url):
+    # ------------------------------------------------------------------------------------------
+    assert images.fetch_bytes(url("/fresh")) == Handler.BODY
+    assert images.fetch_bytes(url("/fresh")) == Handler.BODY
+    assert server.requests == [("/fresh", None)]
+
+
+def test_no_store(server, url):
+    # ------------------------------------------------------------------------------------------
+    assert images.fetch_bytes(url("/no-store")) == Handler.BODY
+    assert images.fetch_bytes(url("/no-store")) == Handler.BODY
+    assert server.requests == [("/no-store", None), ("/no-store", None)]
+
+
+def test_not_found(server, url):
+    # ------------------------------------------------------------------------------------------
+    with pytest.raises(requests.HTTPError):
+        images.fetch_bytes(url("/missing"))
+    with pytest.raises(requests.HTTPError):
+        images.fetch_bytes(url("/missing"))
+    assert len(server.requests) == 2
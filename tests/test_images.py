@@ -0,0 +1,82 @@
+"""
+Image resolver tests: parsers resolving the same src to different images must not
+get each other's from the shared image cache nor from the downloads in flight
+"""
+import base64
+import threading
+from io import BytesIO
+from PIL import Image
+from tkhtmlview import images
+from tkhtmlview.html_parser import HTMLTextParser, Run
+
+
+RED = Image.new("RGB", (4, 4), "red")
+BLUE = Image.new("RGB", (4, 4), "blue")
+
+
+def png(image):
+    # ------------------------------------------------------------------------------------------
+    data = BytesIO()
+    image.save(data, "PNG")
+    return data.getvalue()
+
+
+def color(image):
+    # ------------------------------------------------------------------------------------------
+    return image.convert("RGB").getpixel((0, 0))
+
+
+class BlockingResolver(images.ImageResolver):
+    # ----------------------------------------------------------------------------------------------
+    """
+    Remote resolver of image, blocked until released is set so the downloads of
+    several parsers are in flight together
+    """
+
+    remote = True
+
+    def __init__(self, image, released):
+        # ------------------------------------------------------------------------------------------
+        self.image = image
+        self.released = released
+
+    def resolve(self, src):
+        # ------------------------------------------------------------------------------------------
+        self.released.wait(5)
+        return png(self.image)
+
+
+def test_conflicting_mappings():
+    # ------------------------------------------------------------------------------------------
+    red = HTMLTextParser(image_resolvers=[images.MappingResolver({"logo": RED})])
+    blue = HTMLTextParser(image_resolvers=[images.MappingResolver({"logo": BLUE})])
+    red.load_images([(Run.IMAGE, ("logo", None, None), 0)])
+    blue.load_images([(Run.IMAGE, ("logo", None, None), 0)])
+    assert color(red._cached_image("logo", None, None)) == (255, 0, 0)
+    assert color(blue._cached_image("logo", None, None)) == (0, 0, 255)
+    # resized from the cached image of the parser
+    assert color(blue._cached_image("logo", 2, None)) == (0, 0, 255)
+
+
+def test_default_resolvers_shared():
+    # ------------------------------------------------------------------------------------------
+    src = "data:image/png;base64," + base64.b64encode(png(RED)).decode()
+    HTMLTextParser().load_images([(Run.IMAGE, (src, None, None), 0)])
+    assert color(HTMLTextParser()._cached_image(src, None, None)) == (255, 0, 0)
+
+
+def test_conflicting_downloads():
+    # ------------------------------------------------------------------------------------------
+    released = threading.Event()
+    futures = []
+    for image in (RED, BLUE):
+        parser = HTMLTextParser(image_resolvers=[BlockingResolver(image, released)])
+        resolver = parser.image_resolvers[0]
+        futures.append(
+            images.fetch_image_async(
+                "https://example.com/logo.png", None, None, resolver.resolve, parser._image_scope()
+            )
+        )
+    released.set()
+    assert color(futures[0].result(5)[0]) == (255, 0, 0)
+    assert color(futures[1].result(5)[0]) == (0, 0, 255)
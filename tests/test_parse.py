@@ -0,0 +1,71 @@
+"""
+Parse phase tests, run without a display: parsing html into a Document needs no Tk
+interpreter
+"""
+import pickle
+import tkinter as tk
+import pytest
+from tkhtmlview.html_parser import Document, Run, parse_html
+
+
+@pytest.fixture(autouse=True)
+def no_tk(monkeypatch):
+    # ------------------------------------------------------------------------------------------
+    def fail(*args, **kwargs):
+        raise AssertionError("the parse phase created a Tk interpreter")
+
+    monkeypatch.delenv("DISPLAY", raising=False)
+    monkeypatch.setattr(tk, "Tk", fail)
+
+
+def text_of(document):
+    # ------------------------------------------------------------------------------------------
+    return "".join(value for kind, value, _ in document.runs if kind == Run.TEXT)
+
+
+def test_document_runs():
+    # ------------------------------------------------------------------------------------------
+    document = parse_html("<p>Hello <b>bold</b> text</p><p>next</p>")
+    assert isinstance(document, Document)
+    assert text_of(document) == "Hello bold text\n\nnext"
+    style = document.styles[document.runs[1][2]]
+    assert document.runs[1][1] == "bold"
+    assert style.weight == "bold"
+
+
+def test_styles_interned():
+    # ------------------------------------------------------------------------------------------
+    document = parse_html("<b>one</b> and <b>two</b>")
+    keys = {value: key for _, value, key in document.runs}
+    assert keys["one"] == keys["two"] != keys[" and "]
+    assert len(document.styles) == 2
+
+
+def test_links_and_images():
+    # ------------------------------------------------------------------------------------------
+    document = parse_html('<a href="https://example.com">link</a><img src="a.png" width="10">')
+    kind, value, key = document.runs[0]
+    assert (kind, value) == (Run.TEXT, "link")
+    assert document.styles[key].link == "https://example.com"
+    assert (Run.IMAGE, ("a.png", 10, None)) in [(kind, value) for kind, value, _ in document.runs]
+
+
+def test_strip():
+    # ------------------------------------------------------------------------------------------
+    assert text_of(parse_html("  <p> x </p>  ")) == "x"
+    assert text_of(parse_html("  <p> x </p>  ", strip=False)) == "   x   "
+
+
+def test_stylesheet():
+    # ------------------------------------------------------------------------------------------
+    document = parse_html(
+        '<p class="note" id="t">x</p>', stylesheet="#t { color: blue } p { color: red }"
+    )
+    assert document.styles[document.runs[0][2]].foreground == "blue"
+
+
+def test_document_pickles():
+    # ------------------------------------------------------------------------------------------
+    # documents are sent back from worker processes
+    document = parse_html("<h1>Title</h1><ul><li>one</li><li>two</li></ul>")
+    assert pickle.loads(pickle.dumps(document)) == document
@@ -2,8 +2,12 @@
 tkinter HTML text widgets
 """
 import sys
+import time
 import tkinter as tk
+from concurrent.futures import Future, wait
 from tkhtmlview import html_parser
+from tkhtmlview.html_parser import Document, PlanCache, parse_html
+from tkhtmlview.virtual import VirtualView
 from tkhtmlview.utils import RenderHTML
 
 VERSION = "0.3.1"
@@ -49,14 +53,45 @@ class HTMLScrolledText(_ScrolledText):
     HTML scrolled text widget
     """
 
-    def __init__(self, *args, html=None, **kwargs):
+    def __init__(
+        self,
+        *args,
+        html=None,
+        profile=False,
+        stats_callback=None,
+        plan_cache=None,
+        image_resolvers=None,
+        stylesheet=None,
+        link_handler=None,
+        **kwargs
+    ):
         super().__init__(*args, **kwargs)
         self._w_init(kwargs)
-        self.html_parser = html_parser.HTMLTextParser()
+        self.html_parser = html_parser.HTMLTextParser(
+            profile=profile or bool(stats_callback),
+            plan_cache=plan_cache,
+            image_resolvers=image_resolvers,
+            stylesheet=stylesheet,
+            link_handler=link_handler,
+        )
+        if stats_callback:
+            self.html_parser.stats_callbacks.append(stats_callback)
+        # local images are decoded once scrolled into view
+        self.html_parser.lazy_images = True
+        self._view_job = None
+        self.config(yscrollcommand=self._yscroll)
+        # (html slices, future) of the current non-blocking set_html, or (parse future,
+        # future) of the current set_html_async, and its after job
+        self._render = None
+        self._render_job = None
+        # VirtualView of the last set_html(virtual=True)
+        self._virtual = None
         if isinstance(html, str):
             self.set_html(html)
         elif isinstance(html, RenderHTML):
             self.set_html(html.get_html())
+        elif isinstance(html, Document):
+            self.set_document(html)
 
     def _w_init(self, kwargs):
         if "wrap" not in kwargs.keys():
@@ -67,6 +102,32 @@ class HTMLScrolledText(_ScrolledText):
             else:
                 self.config(background="white")
 
+    def _yscroll(self, first, last):
+        self.vbar.set(first, last)
+        if self._view_job is None:
+            self._view_job = self.after_idle(self._view_update)
+
+    def _view_update(self):
+        self._view_job = None
+        self.html_parser.w_images_show(self)
+        self.html_parser.w_search_show(self)
+
+    @property
+    def render_stats(self):
+        """
+        RenderStats of the last render, None unless the widget was created with
+        profile or stats_callback
+        """
+        return self.html_parser.stats
+
+    @property
+    def resource_counts(self):
+        """
+        Counts of the Tk images, fonts and Tcl commands alive, and of the styles, fonts
+        and images held by the render, to check that repeated renders do not leak
+        """
+        return self.html_parser.w_resource_counts(self)
+
     def fit_height(self):
         """
         Fit widget height to wrapped lines
@@ -79,19 +140,240 @@ class HTMLScrolledText(_ScrolledText):
         else:
             self.config(height=0.5 + 3 / self.yview()[1])
 
-    def set_html(self, html, strip=True):
+    def set_html(self, html, strip=True, block=True, callback=None, diff=False, virtual=False):
         """
         Set HTML widget text. If strip is enabled (default) it ignores spaces and new lines.
+        If block is disabled the text is rendered in time-sliced batches from the event
+        loop, and a future is returned that is done, or cancelled by a newer set_html,
+        once the whole text is displayed. callback is called with the future.
+        If diff is enabled only the lines that differ from the current text are rendered
+        again, keeping the scroll position; it always blocks.
+        If virtual is enabled only the lines around the visible part of the text are
+        rendered, the others are rendered as the text is scrolled.
         """
+        self._render_cancel()
+        if self._virtual is not None:
+            # the text holds only a part of the previous html, there is nothing to diff
+            self._virtual_close()
+            diff = False
+        if virtual:
+            blocks = self.html_parser.w_virtual_begin(self, html, strip=strip)
+            self._virtual = VirtualView(self, self.html_parser, blocks)
+            return None
+
         prev_state = self.cget("state")
         self.config(state=tk.NORMAL)
+        if diff:
+            self.html_parser.w_diff_html(self, html, strip=strip)
+            self.config(state=prev_state)
+            return None
+
         self.delete("1.0", tk.END)
         for tag in self.tag_names():
             self.tag_delete(tag)
 
-        self.html_parser.w_set_html(self, html, strip=strip)
+        if block:
+            self.html_parser.w_set_html(self, html, strip=strip)
+            self.config(state=prev_state)
+            return None
+
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        self.html_parser.w_begin(self, strip=strip)
+        self.config(state=prev_state)
+        self._render = (self._html_slices(html), future)
+        # the first slice alone, so the first screenful is displayed at once
+        self._render_job = self.after_idle(self._render_step, 0)
+        return future
+
+    def set_html_async(self, html, strip=True, callback=None, processes=False):
+        """
+        Set HTML widget text, parsed on a worker thread, or on a worker process if
+        processes is enabled. Only the rendering of the parsed text runs in the event
+        loop. A future is returned that is done, or cancelled by a newer set_html, once
+        the text is displayed. callback is called with the future.
+        """
+        self._render_cancel()
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        job = self.html_parser.parse_document_async(html, strip=strip, processes=processes)
+        self._render = (job, future)
+        self._render_job = self.after(
+            html_parser.Defs.PARSE_POLL_INTERVAL, self._render_document
+        )
+        return future
+
+    def _render_document(self):
+        job, future = self._render
+        if not job.done():
+            self._render_job = self.after(
+                html_parser.Defs.PARSE_POLL_INTERVAL, self._render_document
+            )
+            return
+
+        self._render = self._render_job = None
+        try:
+            self.set_document(job.result())
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        future.set_result(None)
+
+    def set_document(self, document):
+        """
+        Set HTML widget text from a Document returned by parse_html, without parsing
+        the HTML again.
+        """
+        self._render_cancel()
+        self._virtual_close()
+        prev_state = self.cget("state")
+        self.config(state=tk.NORMAL)
+        self.delete("1.0", tk.END)
+        for tag in self.tag_names():
+            self.tag_delete(tag)
+        self.html_parser.w_set_document(self, document)
         self.config(state=prev_state)
 
+    @staticmethod
+    def _html_slices(html):
+        size = html_parser.Defs.RENDER_FIRST_CHUNK_SIZE
+        start = 0
+        while start < len(html):
+            end = html.find("<", start + size)
+            end = len(html) if end < 0 else end
+            yield html[start:end]
+            start = end
+            size = html_parser.Defs.RENDER_CHUNK_SIZE
+
+    def _render_step(self, time_slice=None):
+        slices, future = self._render
+        if time_slice is None:
+            time_slice = html_parser.Defs.RENDER_TIME_SLICE
+        deadline = time.perf_counter() + time_slice
+        prev_state = self.cget("state")
+        self.config(state=tk.NORMAL)
+        try:
+            for chunk in slices:
+                self.html_parser.w_append_html(self, chunk, flush=False)
+                if time.perf_counter() >= deadline:
+                    self._render_job = self.after(1, self._render_step)
+                    return
+            self.html_parser.w_end(self)
+        except Exception as e:
+            self._render = self._render_job = None
+            future.set_exception(e)
+            raise
+        finally:
+            self.config(state=prev_state)
+
+        self._render = self._render_job = None
+        future.set_result(None)
+
+    def _render_cancel(self):
+        if self._render is not None:
+            self.after_cancel(self._render_job)
+            if isinstance(self._render[0], Future):
+                self._render[0].cancel()
+            self._render[1].cancel()
+            self._render = self._render_job = None
+
+    def _render_finish(self):
+        if self._render is not None:
+            self.after_cancel(self._render_job)
+            if isinstance(self._render[0], Future):
+                wait([self._render[0]])
+                self._render_document()
+            else:
+                self._render_step(time_slice=float("inf"))
+
+    def _virtual_close(self):
+        if self._virtual is not None:
+            self._virtual.close()
+            self._virtual = None
+
+    def destroy(self):
+        self._render_cancel()
+        self._virtual_close()
+        if self._view_job is not None:
+            self.after_cancel(self._view_job)
+        self.html_parser.w_release(self)
+        super().destroy()
+
+    def append_html(self, html):
+        """
+        Append HTML to the widget text. The parser state left by the previous call is kept,
+        so only the new content is rendered.
+        """
+        self._render_finish()
+        if self._virtual is not None:
+            self._virtual.extend_blocks(*self.html_parser.w_virtual_append(html))
+            return
+
+        prev_state = self.cget("state")
+        self.config(state=tk.NORMAL)
+        self.html_parser.w_append_html(self, html)
+        self.config(state=prev_state)
+
+    def stream_html(self, chunks, strip=True):
+        """
+        Set HTML widget text from chunks, an iterable of strings or a text file object.
+        Every chunk is displayed as soon as it is read.
+        """
+        if hasattr(chunks, "read"):
+            chunks = iter(lambda: chunks.read(html_parser.Defs.STREAM_CHUNK_SIZE), "")
+
+        self._render_cancel()
+        self._virtual_close()
+        prev_state = self.cget("state")
+        self.config(state=tk.NORMAL)
+        self.delete("1.0", tk.END)
+        for tag in self.tag_names():
+            self.tag_delete(tag)
+
+        self.html_parser.w_begin(self, strip=strip)
+        for chunk in chunks:
+            self.config(state=tk.NORMAL)
+            self.html_parser.w_append_html(self, chunk, flush=False)
+            self.config(state=prev_state)
+            self.update_idletasks()
+        self.config(state=tk.NORMAL)
+        self.html_parser.w_end(self)
+        self.config(state=prev_state)
+
+    def _first_line(self):
+        # line of the document on the first line of the widget
+        return self._virtual.first + 1 if self._virtual is not None else 1
+
+    def highlight_search(self, query, nocase=True):
+        """
+        Highlight the matches of query in the widget text, case insensitive with nocase,
+        and return their number. An empty query clears the search. The matches are found
+        in an index of the text built while it is rendered, see search_next. Unlike
+        tkinter's Text.search, which this widget keeps, it does not scan the widget.
+        """
+        return len(self.html_parser.w_search(self, query, nocase, self._first_line()))
+
+    def search_next(self, backwards=False):
+        """
+        Select the match of the last highlight_search after the selected one, or before
+        it with backwards, and scroll to it. Return the index of its start, None without
+        matches.
+        """
+        parser = self.html_parser
+        offset = parser.w_search_next(self, backwards, self._first_line())
+        if offset is None:
+            return None
+        if self._virtual is not None:
+            self._virtual.see(parser.search_index.line_column(offset)[0] - 1)
+        index1, index2 = parser.search_range(offset, self._first_line())
+        self.tag_remove(tk.SEL, "1.0", tk.END)
+        self.tag_add(tk.SEL, index1, index2)
+        self.mark_set(tk.INSERT, index1)
+        self.see(index1)
+        return self.index(index1)
+
 
 class HTMLText(HTMLScrolledText):
 
@@ -130,5 +412,18 @@ class HTMLLabel(HTMLText):
             self.config(padx=3)
 
     def set_html(self, *args, **kwargs):
-        super().set_html(*args, **kwargs)
+        future = super().set_html(*args, **kwargs)
+        self.config(state=tk.DISABLED)
+        return future
+
+    def set_document(self, *args, **kwargs):
+        super().set_document(*args, **kwargs)
+        self.config(state=tk.DISABLED)
+
+    def append_html(self, *args, **kwargs):
+        super().append_html(*args, **kwargs)
+        self.config(state=tk.DISABLED)
+
+    def stream_html(self, *args, **kwargs):
+        super().stream_html(*args, **kwargs)
         self.config(state=tk.DISABLED)
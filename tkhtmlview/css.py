@@ -0,0 +1,261 @@
+"""
+CSS stylesheets
+"""
+import re
+import hashlib
+import threading
+from functools import lru_cache
+
+
+# compiled stylesheets kept by compile_stylesheet
+STYLESHEET_CACHE_SIZE = 32
+# parsed style attributes kept by parse_style, merged declarations by cascade, and
+# their text widget options by html_parser.resolve_style
+STYLE_CACHE_SIZE = 1024
+# (tag, id, classes) matches kept by each stylesheet, and by match_stylesheets
+MATCH_CACHE_SIZE = 4096
+
+_COMMENT = re.compile(r"/\*.*?\*/", re.DOTALL)
+_BRACE = re.compile(r"[{}]")
+# a compound selector, tag or * followed by #id and .class parts
+_SELECTOR = re.compile(r"(\*|[a-zA-Z][\w-]*)?((?:[#.][\w-]+)*)")
+_SELECTOR_PART = re.compile(r"([#.])([\w-]+)")
+_HEX_COLOR = re.compile(r"#(?:[0-9a-f]{3}){1,4}")
+_NAMED_COLOR = re.compile(r"[a-z][a-z0-9 ]*")
+_RGB_COLOR = re.compile(r"rgb\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\)")
+
+
+# __________________________________________________________________________________________________
+# functions
+def parse_declarations(text):
+    # ------------------------------------------------------------------------------------------
+    """
+    {property: value} of the declarations of a style attribute or a rule, both
+    lowercased
+    """
+    declarations = {}
+    for declaration in text.split(";"):
+        name, colon, value = declaration.partition(":")
+        if colon:
+            value = value.strip().lower()
+            if value.endswith("!important"):
+                value = value[: -len("!important")].rstrip()
+            declarations[name.strip().lower()] = value
+    return declarations
+
+
+@lru_cache(maxsize=STYLE_CACHE_SIZE)
+def parse_style(text):
+    # ------------------------------------------------------------------------------------------
+    """
+    Declarations of a style attribute, parsed once per distinct text
+    """
+    return Declarations(parse_declarations(text))
+
+
+@lru_cache(maxsize=STYLE_CACHE_SIZE)
+def cascade(*declarations):
+    # ------------------------------------------------------------------------------------------
+    """
+    Declarations merged in order, the later ones override the earlier ones
+    """
+    merged = {}
+    for d in declarations:
+        merged.update(d)
+    return Declarations(merged)
+
+
+def parse_color(value):
+    # ------------------------------------------------------------------------------------------
+    """
+    Tk color of a css color, #hex, rgb() or a name, None if its syntax is not valid
+    """
+    if _HEX_COLOR.fullmatch(value) or _NAMED_COLOR.fullmatch(value):
+        return value
+    match = _RGB_COLOR.fullmatch(value)
+    if match:
+        return "#%02x%02x%02x" % tuple(min(int(c), 255) for c in match.groups())
+    return None
+
+
+def _blocks(text):
+    # ------------------------------------------------------------------------------------------
+    """
+    Yield the (prelude, body) of the top level blocks of text, without comments
+    """
+    text = _COMMENT.sub("", text)
+    depth, start, prelude = 0, 0, None
+    for match in _BRACE.finditer(text):
+        if match.group() == "{":
+            if not depth:
+                prelude, start = text[start : match.start()], match.end()
+            depth += 1
+        elif depth:
+            depth -= 1
+            if not depth:
+                yield prelude, text[start : match.start()]
+                start = match.end()
+
+
+def _parse_selector(text):
+    # ------------------------------------------------------------------------------------------
+    """
+    (tag, ids, classes) of a compound selector, None for the selectors that are
+    not supported (combinators, pseudo-classes and attributes)
+    """
+    match = _SELECTOR.fullmatch(text)
+    if match is None or not text:
+        return None
+    tag = match.group(1)
+    tag = None if tag in (None, "*") else tag.lower()
+    ids, classes = [], []
+    for kind, name in _SELECTOR_PART.findall(match.group(2)):
+        (ids if kind == "#" else classes).append(name)
+    return tag, frozenset(ids), frozenset(classes)
+
+
+@lru_cache(maxsize=MATCH_CACHE_SIZE)
+def match_stylesheets(stylesheets, tag, id_=None, classes=()):
+    # ------------------------------------------------------------------------------------------
+    """
+    Declarations of the rules of the tuple of stylesheets matching an element. The
+    rules are ordered by specificity across all the stylesheets, then by stylesheet
+    and by rule, so a more specific rule of an earlier stylesheet still wins.
+    """
+    declarations = {}
+    for _, _, _, rule_declarations in sorted(
+        (specificity, i, index, rule_declarations)
+        for i, stylesheet in enumerate(stylesheets)
+        for specificity, index, rule_declarations in stylesheet.match_rules(tag, id_, classes)
+    ):
+        declarations.update(rule_declarations)
+    return Declarations(declarations)
+
+
+@lru_cache(maxsize=STYLESHEET_CACHE_SIZE)
+def compile_stylesheet(text):
+    # ------------------------------------------------------------------------------------------
+    """
+    Stylesheet of the css text, compiled once and shared by every parser using the
+    same text
+    """
+    return Stylesheet(text)
+
+
+# __________________________________________________________________________________________________
+# classes
+class Declarations(dict):
+    # ----------------------------------------------------------------------------------------------
+    """
+    Immutable {property: value} of css declarations, hashable so the results
+    derived from them can be cached
+    """
+
+    __slots__ = ("_hash",)
+
+    def __hash__(self):
+        # ------------------------------------------------------------------------------------------
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = hash(frozenset(self.items()))
+            return self._hash
+
+    def __reduce__(self):
+        # ------------------------------------------------------------------------------------------
+        return self.__class__, (dict(self),)
+
+    def _immutable(self, *args, **kwargs):
+        # ------------------------------------------------------------------------------------------
+        raise TypeError(f"{self.__class__.__name__} is immutable")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+EMPTY_DECLARATIONS = Declarations()
+
+
+class Stylesheet:
+    # ----------------------------------------------------------------------------------------------
+    """
+    Rules of a css text, indexed by the id, else a class, else the tag of their
+    selector, so the rules matching an element are found without testing all of
+    them. Only compound selectors of a tag, ids and classes are supported, the
+    rules of other selectors and of at-rules are ignored.
+    """
+
+    def __init__(self, text):
+        # ------------------------------------------------------------------------------------------
+        self.text = text
+        self.key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        self._by_id = {}
+        self._by_class = {}
+        self._by_tag = {}
+        self._universal = []
+        self._matches = {}
+        self._lock = threading.Lock()
+        self.rules = 0
+
+        for prelude, body in _blocks(text):
+            # statements such as @import end before the selectors of the block
+            prelude = prelude.rpartition(";")[2].strip()
+            if not prelude or prelude.startswith("@"):
+                continue
+            declarations = parse_declarations(body)
+            for selector in prelude.split(","):
+                selector = _parse_selector(selector.strip())
+                if selector is None or not declarations:
+                    continue
+                tag, ids, classes = selector
+                specificity = (len(ids), len(classes), tag is not None)
+                rule = (specificity, self.rules, tag, ids, classes, declarations)
+                self.rules += 1
+                if ids:
+                    self._by_id.setdefault(next(iter(ids)), []).append(rule)
+                elif classes:
+                    self._by_class.setdefault(next(iter(classes)), []).append(rule)
+                elif tag is not None:
+                    self._by_tag.setdefault(tag, []).append(rule)
+                else:
+                    self._universal.append(rule)
+
+    def match_rules(self, tag, id_=None, classes=()):
+        # ------------------------------------------------------------------------------------------
+        """
+        (specificity, rule index, declarations) of the rules matching an element, in
+        cascade order
+        """
+        key = (tag, id_, classes)
+        rules = self._matches.get(key)
+        if rules is not None:
+            return rules
+
+        class_set = frozenset(classes)
+        candidates = list(self._by_tag.get(tag, ())) + self._universal
+        if id_ is not None:
+            candidates += self._by_id.get(id_, ())
+        for name in class_set:
+            candidates += self._by_class.get(name, ())
+        rules = tuple(
+            (specificity, index, declarations)
+            for specificity, index, rule_tag, ids, rule_classes, declarations in sorted(
+                candidates
+            )
+            if (rule_tag is None or rule_tag == tag)
+            and ids <= {id_}
+            and rule_classes <= class_set
+        )
+
+        with self._lock:
+            if len(self._matches) >= MATCH_CACHE_SIZE:
+                self._matches.clear()
+            self._matches[key] = rules
+        return rules
+
+    def match(self, tag, id_=None, classes=()):
+        # ------------------------------------------------------------------------------------------
+        """
+        Declarations of the rules matching an element, in cascade order
+        """
+        return match_stylesheets((self,), tag, id_, classes)
@@ -1,16 +1,24 @@
 """
 HTML parser
 """
-import os
+import re
+import time
+import difflib
+import hashlib
+import multiprocessing
+import threading
 import webbrowser
 import tkinter as tk
 from tkinter import font
-from copy import deepcopy
-from PIL import Image, ImageTk
+from PIL import ImageTk
 from html.parser import HTMLParser
-from collections import OrderedDict
-import requests
-from io import BytesIO
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from functools import lru_cache
+from tkhtmlview import css, images
+from tkhtmlview.search import SearchIndex
 
 
 # __________________________________________________________________________________________________
@@ -26,6 +34,31 @@ class Defs:
         "h5": 13,
         "h6": 10,
     }
+    IMAGE_PLACEHOLDER_SIZE = (32, 32)
+    IMAGE_POLL_INTERVAL = 50
+    STREAM_CHUNK_SIZE = 64 * 1024
+    RENDER_FIRST_CHUNK_SIZE = 4 * 1024
+    RENDER_CHUNK_SIZE = 16 * 1024
+    RENDER_TIME_SLICE = 0.02
+    DIFF_MARK = "tkhtmlview_diff"
+    LINK_TAG = "tkhtmlview_link"
+    LINK_CURSOR = "hand2"
+    DIFF_MAX_BLOCKS = 2000
+    WHITESPACE = re.compile(r"[ \t\n]+")
+    TABLE_CELL_SPACING = 12
+    MEASURE_CACHE_SIZE = 64 * 1024
+    VIRTUAL_MARK = "tkhtmlview_virtual"
+    VIRTUAL_MARGIN = 2
+    PARSE_THREADS = 2
+    # forking a process running threads and a Tk interpreter may deadlock the child
+    PARSE_START_METHOD = "spawn"
+    PARSE_POLL_INTERVAL = 20
+    PLAN_CACHE_ENTRIES = 64
+    LAZY_IMAGE_MARGIN = 20
+    SEARCH_TAG = "tkhtmlview_search"
+    SEARCH_BACKGROUND = "yellow"
+    SEARCH_MARGIN = 50
+    PLAN_CACHE_BYTES = 16 * 1024 * 1024
 
 
 class HTML:
@@ -62,9 +95,12 @@ class HTML:
         TR = "tr"
         TH = "th"
         TD = "td"
+        STYLE = "style"
 
     class Attrs:
         STYLE = "style"
+        CLASS = "class"
+        ID = "id"
         HREF = "href"
         SRC = "src"
         WIDTH = "width"
@@ -162,72 +198,259 @@ class Bind:
     IMAGE = "image"
 
 
-class WTag:
-    START_INDEX = "start_index"
-    END_INDEX = "end_index"
-
-
-DEFAULT_STACK = {
-    WCfg.KEY: {
-        WCfg.BACKGROUND: [],
-        WCfg.FOREGROUND: [("__DEFAULT__", "black")],
-        WCfg.JUSTIFY: [("__DEFAULT__", "left")],
-        WCfg.TABS: [("__DEFAULT__", ())],
-    },
-    Fnt.KEY: {
-        Fnt.FAMILY: [],
-        Fnt.SIZE: [("__DEFAULT__", Defs.FONT_SIZE)],
-        Fnt.WEIGHT: [("__DEFAULT__", "normal")],
-        Fnt.SLANT: [("__DEFAULT__", "roman")],
-        Fnt.UNDERLINE: [("__DEFAULT__", False)],
-        Fnt.OVERSTRIKE: [("__DEFAULT__", False)],
-    },
-    Bind.KEY: {
-        Bind.LINK: [("__DEFAULT__", None)],
-    },
+class Layout:
+    KEY = "layout"
+    TABLE = "table"
+    CELL_END = re.compile(r"[\t\n]")
+
+
+class Run:
+    TEXT = "text"
+    IMAGE = "image"
+
+
+# computed style of an element, one field per option of its text widget tag
+Style = namedtuple(
+    "Style",
+    (
+        WCfg.BACKGROUND,
+        WCfg.FOREGROUND,
+        WCfg.JUSTIFY,
+        WCfg.TABS,
+        Fnt.FAMILY,
+        Fnt.SIZE,
+        Fnt.WEIGHT,
+        Fnt.SLANT,
+        Fnt.UNDERLINE,
+        Fnt.OVERSTRIKE,
+        Bind.LINK,
+        Layout.TABLE,
+    ),
+)
+
+STYLE_KEYS = {
+    WCfg.KEY: (WCfg.BACKGROUND, WCfg.FOREGROUND, WCfg.JUSTIFY, WCfg.TABS),
+    Fnt.KEY: (Fnt.FAMILY, Fnt.SIZE, Fnt.WEIGHT, Fnt.SLANT, Fnt.UNDERLINE, Fnt.OVERSTRIKE),
+    Bind.KEY: (Bind.LINK,),
+    Layout.KEY: (Layout.TABLE,),
 }
 
+# background and font family are set by parse_begin, a font family may be a tuple
+# of candidates, resolved once a font is created
+DEFAULT_STYLE = Style(
+    background=None,
+    foreground="black",
+    justify="left",
+    tabs=(),
+    family=None,
+    size=Defs.FONT_SIZE,
+    weight="normal",
+    slant="roman",
+    underline=False,
+    overstrike=False,
+    link=None,
+    table=None,
+)
+
+
+# parsed html, runs are (kind, value, index in styles) tuples, a style without
+# background takes the one of the widget
+Document = namedtuple("Document", ("runs", "styles", "strip"))
+
+# parsed html kept by PlanCache, with the parser state needed to append more html
+Plan = namedtuple("Plan", ("document", "stack", "html_tags", "stylesheets"))
+
+
+# __________________________________________________________________________________________________
+# process-wide font caches, shared by every parser and widget
+
+_font_families = None
+_resolved_font_families = {}
+_fonts = {}
+# renders holding each font of _fonts, see RenderResources
+_font_refs = {}
+# widths in pixels of texts, keyed by (font options, text)
+_text_widths = {}
+
+# worker pools of parse_document_async, created on first use
+_parse_executors = {}
+_parse_executors_lock = threading.Lock()
+
 
 # __________________________________________________________________________________________________
 # functions
-def get_existing_font(font_families):
+def get_font_families():
     # ------------------------------------------------------------------------------------------
-    try:
-        return next(
-            filter(
-                lambda f: f.lower() in (f.lower() for f in font.families()),
-                font_families,
-            )
+    """
+    Lowercased names of the installed font families, enumerated only once
+    """
+    global _font_families
+    if _font_families is None:
+        _font_families = frozenset(f.lower() for f in font.families())
+    return _font_families
+
+
+def get_existing_font(font_families, default="TkTextFont"):
+    # ------------------------------------------------------------------------------------------
+    font_families = tuple(font_families)
+    if font_families not in _resolved_font_families:
+        try:
+            families = get_font_families()
+        except Exception:
+            return default
+        _resolved_font_families[font_families] = next(
+            (f for f in font_families if f.lower() in families), None
         )
-    except Exception:
-        return "TkTextFont"
 
+    return _resolved_font_families[font_families] or default
 
-# __________________________________________________________________________________________________
-# classes
-class HLinkSlot:
-    # ----------------------------------------------------------------------------------------------
 
-    def __init__(self, w, tag_name, url):
-        # ------------------------------------------------------------------------------------------
-        self._w = w
-        self.tag_name = tag_name
-        self.URL = url
+def get_font(root, **options):
+    # ------------------------------------------------------------------------------------------
+    """
+    Shared font.Font for the given options, created once per Tk interpreter
+    """
+    key = tuple(sorted(options.items()))
+    cached = _fonts.get(key)
+    if cached is None or cached[0] is not root.tk:
+        if isinstance(options.get(Fnt.FAMILY), tuple):
+            options[Fnt.FAMILY] = get_existing_font(options[Fnt.FAMILY])
+        cached = _fonts[key] = (root.tk, font.Font(root=root, **options))
+    return cached[1]
 
-    def call(self, event):
-        # ------------------------------------------------------------------------------------------
-        webbrowser.open(self.URL)
-        self._w.tag_config(self.tag_name, foreground="purple")
 
-    def enter(self, event):
-        # ------------------------------------------------------------------------------------------
-        self._w.config(cursor="hand2")
+@lru_cache(maxsize=css.STYLE_CACHE_SIZE)
+def resolve_style(declarations, default_family):
+    # ------------------------------------------------------------------------------------------
+    """
+    {option: value} of the text widget options set by css declarations, computed
+    once per distinct declarations. Colors of invalid syntax are left out, and the
+    css font families are followed by default_family. The result is shared, it
+    must not be modified.
+    """
+    options = {}
+    for option, name in (
+        (WCfg.FOREGROUND, HTML.Style.COLOR),
+        (WCfg.BACKGROUND, HTML.Style.BACKGROUND_COLOR),
+    ):
+        if name in declarations:
+            color = css.parse_color(declarations[name])
+            if color is not None:
+                options[option] = color
+
+    if HTML.Style.FONT_FAMILY in declarations:
+        options[Fnt.FAMILY] = tuple(
+            f.strip() for f in declarations[HTML.Style.FONT_FAMILY].split(",")
+        ) + (default_family if isinstance(default_family, tuple) else (default_family,))
+
+    if HTML.Style.FONT_SIZE in declarations:
+        value = declarations[HTML.Style.FONT_SIZE]
+        size = Defs.FONT_SIZE
+        if value.endswith("px"):
+            if value[:-2].isdigit():
+                size = int(value[:-2])
+        elif value.endswith("%"):
+            if value[:-1].isdigit():
+                size = int((int(value[:-1]) * Defs.FONT_SIZE) / 100)
+        options[Fnt.SIZE] = size
+
+    if HTML.Style.TEXT_ALIGN in declarations:
+        options[WCfg.JUSTIFY] = declarations[HTML.Style.TEXT_ALIGN]
+
+    if HTML.Style.TEXT_DECORATION in declarations:
+        decoration = declarations[HTML.Style.TEXT_DECORATION]
+        if HTML.StyleTextDecoration.UNDERLINE in decoration:
+            options[Fnt.UNDERLINE], options[Fnt.OVERSTRIKE] = True, False
+        elif HTML.StyleTextDecoration.LINE_THROUGH in decoration:
+            options[Fnt.UNDERLINE], options[Fnt.OVERSTRIKE] = False, True
+        else:
+            options[Fnt.UNDERLINE], options[Fnt.OVERSTRIKE] = None, None
+    return options
 
-    def leave(self, event):
-        # ------------------------------------------------------------------------------------------
-        self._w.config(cursor="")
+
+def parse_html(html, strip=True, stylesheet=None):
+    # ------------------------------------------------------------------------------------------
+    """
+    Parse html into a Document, which any number of widgets can render with
+    set_document. No Tk interpreter is needed, so it can run in a worker process.
+    stylesheet is css text applied before the <style> elements of html.
+    """
+    return HTMLTextParser(stylesheet=stylesheet).parse_document(html, strip=strip)
 
 
+def diff_blocks(old, new):
+    # ------------------------------------------------------------------------------------------
+    """
+    (i1, i2, j1, j2) of the changes turning the blocks old into new, in order, each
+    replacing old[i1:i2] with new[j1:j2]. The common prefix and suffix are skipped
+    first, and only the middle is diffed, or replaced whole past
+    Defs.DIFF_MAX_BLOCKS blocks.
+    """
+    prefix, end = 0, min(len(old), len(new))
+    while prefix < end and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < end - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    old_end, new_end = len(old) - suffix, len(new) - suffix
+    if prefix == old_end and prefix == new_end:
+        return []
+    if (
+        prefix == old_end
+        or prefix == new_end
+        or max(old_end, new_end) - prefix > Defs.DIFF_MAX_BLOCKS
+    ):
+        return [(prefix, old_end, prefix, new_end)]
+
+    ids = {}
+    old_units, old_starts = _blocks_units(old, prefix, old_end, ids)
+    new_units, new_starts = _blocks_units(new, prefix, new_end, ids)
+    matcher = difflib.SequenceMatcher(None, old_units, new_units, autojunk=False)
+    return [
+        (old_starts[i1], old_starts[i2], new_starts[j1], new_starts[j2])
+        for op, i1, i2, j1, j2 in matcher.get_opcodes()
+        if op != "equal"
+    ]
+
+
+def _blocks_units(blocks, start, end, ids):
+    # ------------------------------------------------------------------------------------------
+    """
+    (ids, start block indices) of the units of blocks[start:end], the blank lines
+    are folded into the block before them so the many identical blank lines do not
+    make the diff quadratic. Units are numbered in ids, equal units share an id.
+    """
+    units, starts = [], []
+    for i in range(start, end):
+        block = blocks[i]
+        if units and len(block) == 1 and block[0][1] == "\n":
+            units[-1] += (block,)
+        else:
+            units.append((block,))
+            starts.append(i)
+    starts.append(end)
+    return [ids.setdefault(unit, len(ids)) for unit in units], starts
+
+
+def get_parse_executor(processes=False):
+    # ------------------------------------------------------------------------------------------
+    with _parse_executors_lock:
+        executor = _parse_executors.get(processes)
+        if executor is None:
+            if processes:
+                executor = ProcessPoolExecutor(
+                    mp_context=multiprocessing.get_context(Defs.PARSE_START_METHOD)
+                )
+            else:
+                executor = ThreadPoolExecutor(
+                    max_workers=Defs.PARSE_THREADS, thread_name_prefix="tkhtmlview-parse"
+                )
+            _parse_executors[processes] = executor
+    return executor
+
+
+# __________________________________________________________________________________________________
+# classes
 class ListTag:
     # ----------------------------------------------------------------------------------------------
     def __init__(self, ordered: bool, list_type=None):
@@ -261,22 +484,232 @@ class ListTag:
         return prefix + chr(0x60 + index)
 
 
-class HTMLTextParser(HTMLParser):
+class PlanCache:
+    # ----------------------------------------------------------------------------------------------
+    """
+    Plans of parsed html keyed by a hash of the html and the settings it was parsed
+    with, evicted in least recently used order beyond max_entries plans or about
+    max_bytes of text. Plans do not depend on a parser, so widgets can share a cache.
+    """
+
+    def __init__(self, max_entries=Defs.PLAN_CACHE_ENTRIES, max_bytes=Defs.PLAN_CACHE_BYTES):
+        # ------------------------------------------------------------------------------------------
+        self._plans = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def plan_nbytes(plan):
+        # ------------------------------------------------------------------------------------------
+        # text plus a rough size of each run tuple
+        return sum(
+            (len(value) if kind == Run.TEXT else 0) + 64 for kind, value, _ in plan.document.runs
+        )
+
+    def get(self, key):
+        # ------------------------------------------------------------------------------------------
+        entry = self._plans.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._plans.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, plan):
+        # ------------------------------------------------------------------------------------------
+        nbytes = self.plan_nbytes(plan)
+        if key in self._plans:
+            self.nbytes -= self._plans.pop(key)[1]
+        if nbytes > self.max_bytes:
+            return
+        self._plans[key] = (plan, nbytes)
+        self.nbytes += nbytes
+        while len(self._plans) > self.max_entries or self.nbytes > self.max_bytes:
+            self.nbytes -= self._plans.popitem(last=False)[1][1]
+
+    def clear(self):
+        # ------------------------------------------------------------------------------------------
+        self._plans.clear()
+        self.nbytes = 0
+
+    def __contains__(self, key):
+        # ------------------------------------------------------------------------------------------
+        return key in self._plans
+
+    def __len__(self):
+        # ------------------------------------------------------------------------------------------
+        return len(self._plans)
+
+
+class RenderResources:
     # ----------------------------------------------------------------------------------------------
+    """
+    Tk resources owned by a render: the fonts of its tags, its images and the Tcl
+    commands registered for it. They are released together once the render is
+    replaced or its widget destroyed. Fonts are shared by the renders using them
+    and deleted with the last one.
+    """
 
     def __init__(self):
         # ------------------------------------------------------------------------------------------
-        super().__init__()
-        # set list tabs
-        self.cached_images = {}
+        self.fonts = set()
+        self.images = set()
+        self.commands = []
+
+    def add_font(self, key):
+        # ------------------------------------------------------------------------------------------
+        # key of the font in _fonts
+        if key not in self.fonts:
+            self.fonts.add(key)
+            _font_refs[key] = _font_refs.get(key, 0) + 1
+
+    def add_image(self, image):
+        # ------------------------------------------------------------------------------------------
+        self.images.add(image)
+
+    def register(self, w, func):
+        # ------------------------------------------------------------------------------------------
+        """
+        Tcl command of func for the widget w, deleted on release
+        """
+        name = w.register(func)
+        self.commands.append((w, name))
+        return name
+
+    def release_images(self, images):
+        # ------------------------------------------------------------------------------------------
+        for image in images:
+            self.images.discard(image)
+            try:
+                image.tk.call("image", "delete", str(image))
+            except tk.TclError:
+                pass
+
+    def release(self):
+        # ------------------------------------------------------------------------------------------
+        for key in self.fonts:
+            refs = _font_refs.pop(key, 1) - 1
+            if refs:
+                _font_refs[key] = refs
+            else:
+                # the Tk font is deleted with the last reference to its font.Font
+                _fonts.pop(key, None)
+        self.fonts = set()
+        self.release_images(list(self.images))
+        for w, name in self.commands:
+            try:
+                w.deletecommand(name)
+            except tk.TclError:
+                pass
+        self.commands = []
+
+
+class RenderStats:
+    # ----------------------------------------------------------------------------------------------
+    """
+    Timings in seconds of the render phases and counts of what a render produced.
+    Images still downloading when the render ends are counted in images_pending,
+    and moved to images once they are displayed.
+    """
+
+    PHASES = ("parse", "diff", "tags", "insert", "images")
+
+    def __init__(self):
+        # ------------------------------------------------------------------------------------------
+        self.timings = dict.fromkeys(self.PHASES, 0.0)
+        self.nodes = 0
+        self.runs = 0
+        self.tags = 0
+        self.fonts = 0
+        self.images = 0
+        self.images_pending = 0
+        self.bytes_fetched = 0
+        self.downloads = set()
+
+    def as_dict(self):
+        # ------------------------------------------------------------------------------------------
+        return {
+            "timings": dict(self.timings),
+            "nodes": self.nodes,
+            "runs": self.runs,
+            "tags": self.tags,
+            "fonts": self.fonts,
+            "images": self.images,
+            "images_pending": self.images_pending,
+            "bytes_fetched": self.bytes_fetched,
+        }
+
+    def __repr__(self):
+        # ------------------------------------------------------------------------------------------
+        return f"<{self.__class__.__name__}: {self.as_dict()}>"
 
-        self.DEFAULT_TEXT_FONT_FAMILY = get_existing_font(Defs.DEFAULT_TEXT_FONT_FAMILY)
-        self.PREFORMATTED_FONT_FAMILY = get_existing_font(Defs.PREFORMATTED_FONT_FAMILY)
+
+class HTMLTextParser(HTMLParser):
+    # ----------------------------------------------------------------------------------------------
+
+    def __init__(
+        self,
+        image_cache=None,
+        profile=False,
+        plan_cache=None,
+        image_resolvers=None,
+        stylesheet=None,
+        link_handler=None,
+    ):
+        # ------------------------------------------------------------------------------------------
+        super().__init__()
+        # PlanCache used by w_set_html and w_diff_html, disabled by default
+        self.plan_cache = plan_cache
+        # with profile, self.stats holds the RenderStats of the last render and
+        # every callable of self.stats_callbacks is called with it
+        self.profile = profile
+        self.stats = None
+        self.stats_callbacks = []
+        # decoded images, shared with the other parsers by default
+        self.cached_images = images.image_cache if image_cache is None else image_cache
+        # called with the url of a clicked link
+        self.link_handler = webbrowser.open if link_handler is None else link_handler
+        # [Tcl commands of the link bindings, cursor saved on enter] by widget
+        self._w_link_widgets = {}
+        # css.Stylesheet of the css text stylesheet, applied before the <style> elements
+        self.stylesheet = css.compile_stylesheet(stylesheet) if stylesheet else None
+        # ImageResolver list finding the image of an img src, tried in order
+        self.image_resolvers = (
+            images.default_resolvers() if image_resolvers is None else list(image_resolvers)
+        )
+        # with lazy_images, local images are decoded once in view, see w_images_show
+        self.lazy_images = False
+        self._w_lazy_images = {}
+        self.runs = None
+        # styles are interned for the lifetime of the parser, so tag names stay the
+        # same across renders
+        self._w_tags = OrderedDict()
+        self._w_styles = {}
+        self._w_font_keys = {}
+        self._w_tag_count = 0
+        self.w_resources = RenderResources()
+        # True while the widget holds only a window of the runs, see w_virtual_begin
+        self._virtual = False
+        # plain text of the applied runs, see w_search
+        self.search_index = SearchIndex()
+        # [query, nocase, offset of the current match] of the last w_search
+        self._w_search = None
+        # (first, last) document lines with their matches highlighted
+        self._w_search_shown = None
+
+        self.DEFAULT_TEXT_FONT_FAMILY = Defs.DEFAULT_TEXT_FONT_FAMILY
+        self.PREFORMATTED_FONT_FAMILY = Defs.PREFORMATTED_FONT_FAMILY
 
     def _parse_attrs(self, attrs):
         # ------------------------------------------------------------------------------------------
         attrs_dict = {
-            HTML.Attrs.STYLE: {},
+            HTML.Attrs.STYLE: css.EMPTY_DECLARATIONS,
+            HTML.Attrs.CLASS: (),
+            HTML.Attrs.ID: None,
             HTML.Attrs.HREF: None,
             HTML.Attrs.SRC: None,
             HTML.Attrs.WIDTH: None,
@@ -286,13 +719,12 @@ class HTMLTextParser(HTMLParser):
         for k, v in attrs:
             k = k.lower()
             if k == HTML.Attrs.STYLE:
-                for p in v.split(";"):
-                    try:
-                        p_key = p.split(":")[0].strip().lower()
-                        p_value = p.split(":")[1].strip().lower()
-                        attrs_dict[HTML.Attrs.STYLE][p_key] = p_value
-                    except:
-                        pass
+                if v:
+                    attrs_dict[k] = css.parse_style(v)
+            elif k == HTML.Attrs.CLASS:
+                attrs_dict[k] = tuple(v.split()) if v else ()
+            elif k == HTML.Attrs.ID:
+                attrs_dict[k] = v
             elif k in (
                 HTML.Attrs.HREF,
                 HTML.Attrs.SRC,
@@ -303,178 +735,208 @@ class HTMLTextParser(HTMLParser):
                 attrs_dict[k] = v
         return attrs_dict
 
-    def _w_tags_add(self):
+    def _css_styles(self, tag, attrs):
         # ------------------------------------------------------------------------------------------
-        tag = {WCfg.KEY: {}, Fnt.KEY: {}, Bind.KEY: {}}
-
-        for k1 in (WCfg.KEY, Fnt.KEY, Bind.KEY):
-            for k2 in DEFAULT_STACK[k1]:
-                tag[k1][k2] = self.stack[k1][k2][-1][1]
-
-        self._w_tags[self._w.index("end-1c")] = tag
+        """
+        Declarations of the stylesheets matching the element, overridden by its
+        style attribute
+        """
+        return css.cascade(
+            css.match_stylesheets(
+                self._stylesheets, tag, attrs[HTML.Attrs.ID], attrs[HTML.Attrs.CLASS]
+            ),
+            attrs[HTML.Attrs.STYLE],
+        )
 
-    def _stack_get_main_key(self, key):
+    def _w_tags_add(self):
         # ------------------------------------------------------------------------------------------
-        if key in WCfg.__dict__.values():
-            main_key = WCfg.KEY
-        elif key in Fnt.__dict__.values():
-            main_key = Fnt.KEY
-        elif key in Bind.__dict__.values():
-            main_key = Bind.KEY
-        else:
-            raise ValueError(f"key {key} doesn't exists")
-
-        return main_key
+        self._style_key = self._style_key_of(self.stack[-1][2])
 
-    def _stack_add(self, tag, key, value=None):
+    def _style_key_of(self, style):
         # ------------------------------------------------------------------------------------------
-        main_key = self._stack_get_main_key(key)
-
-        if value is None:
-            # if value is none, add the previous value
-            value = self.stack[main_key][key][-1][1]
+        # identical styles share one tag, so the key is the full computed style
+        key = self._w_styles.get(style)
+        if key is None:
+            key = f"tag{self._w_tag_count}"
+            self._w_tag_count += 1
+            self._w_styles[style] = key
+            self._w_tags[key] = {
+                k1: {k2: getattr(style, k2) for k2 in k2s} for k1, k2s in STYLE_KEYS.items()
+            }
+        return key
 
-        self.stack[main_key][key].append((tag, value))
+    # ----------------------------------------------------------------------------------------------
+    # run list, the widget-independent output of the parse phase
 
-    def _stack_index(self, tag, key):
+    def _insert_text(self, text):
         # ------------------------------------------------------------------------------------------
-        main_key = self._stack_get_main_key(key)
-        index = None
-        for i, v in enumerate(self.stack[main_key][key]):
-            if v[0] == tag:
-                index = i
-
-        return index
+        if text:
+            self.runs.append((Run.TEXT, text, self._style_key))
 
-    def _stack_pop(self, tag, key):
+    def _insert_image(self, image):
         # ------------------------------------------------------------------------------------------
-        main_key = self._stack_get_main_key(key)
+        self.runs.append((Run.IMAGE, image, self._style_key))
 
-        index = None
-        if len(self.stack[main_key][key]) > 1:
-            index = self._stack_index(tag, key)
+    def _text_tail(self, count):
+        # ------------------------------------------------------------------------------------------
+        """
+        Last count characters of the parsed text, an image counts as one character
+        """
+        tail = ""
+        for kind, value, _ in reversed(self.runs):
+            tail = (value if kind == Run.TEXT else "\ufffc") + tail
+            if len(tail) >= count:
+                break
+        return tail[-count:]
+
+    def _text_last(self):
+        # ------------------------------------------------------------------------------------------
+        """
+        Last character of the parsed text, "" if there is none
+        """
+        if not self.runs:
+            return ""
+        kind, value, _ = self.runs[-1]
+        return value[-1] if kind == Run.TEXT else "\ufffc"
+
+    def _text_empty(self):
+        # ------------------------------------------------------------------------------------------
+        return not self.runs
 
-        if index is not None:
-            return self.stack[main_key][key].pop(index)[1]
+    def _text_delete_last(self):
+        # ------------------------------------------------------------------------------------------
+        applied = self._applied == (len(self.runs), 0)
+        kind, value, key = self.runs.pop()
+        if kind == Run.TEXT and len(value) > 1:
+            self.runs.append((kind, value[:-1], key))
+
+        if applied:
+            # the character is already in the widget, remove it on the next apply
+            self._w_trim += 1
+            if kind == Run.TEXT:
+                self.search_index.truncate(len(self.search_index) - 1)
+            self._applied = (len(self.runs), 0)
+        elif self._applied[1] and self._applied == (len(self.runs) - 1, len(self.runs[-1][1])):
+            self._applied = (len(self.runs), 0)
+
+    def _stack_push(self, tag, props):
+        # ------------------------------------------------------------------------------------------
+        """
+        Open a frame for tag, with the style of the parent frame updated by props.
+        A prop set to None keeps the parent value.
+        """
+        parent = self.stack[-1][2]
+        props = {k: getattr(parent, k) if v is None else v for k, v in props.items()}
+        self.stack.append((tag, props, parent._replace(**props)))
+
+    def _stack_pop(self, tag):
+        # ------------------------------------------------------------------------------------------
+        stack = self.stack
+        if stack[-1][0] == tag:
+            stack.pop()
+            return
+
+        # mismatched nesting, close the last frame of tag and compute again the
+        # style of the frames opened after it, which keep their own props
+        for index in range(len(stack) - 1, 0, -1):
+            if stack[index][0] == tag:
+                break
+        else:
+            return
+        del stack[index]
+        for i in range(index, len(stack)):
+            frame_tag, props, _ = stack[i]
+            stack[i] = (frame_tag, props, stack[i - 1][2]._replace(**props))
 
     def _parse_styles(self, tag, attrs):
         # ------------------------------------------------------------------------------------------
+        style = resolve_style(attrs[HTML.Attrs.STYLE], self.DEFAULT_TEXT_FONT_FAMILY)
+        props = {}
         # -------------------------------------------------------------------------------- [ COLOR ]
-        if HTML.Style.COLOR in attrs[HTML.Attrs.STYLE].keys():
-            self._stack_add(
-                tag, WCfg.FOREGROUND, attrs[HTML.Attrs.STYLE][HTML.Style.COLOR]
-            )
+        if WCfg.FOREGROUND in style:
+            props[WCfg.FOREGROUND] = style[WCfg.FOREGROUND]
         elif tag == HTML.Tag.A and attrs[HTML.Attrs.HREF]:
-            self._stack_add(tag, WCfg.FOREGROUND, "blue")
+            props[WCfg.FOREGROUND] = "blue"
         else:
-            self._stack_add(tag, WCfg.FOREGROUND)
+            props[WCfg.FOREGROUND] = None
 
         # ---------------------------------------------------------------------- [ BACKGROUND_COLOR ]
-        if HTML.Style.BACKGROUND_COLOR in attrs[HTML.Attrs.STYLE].keys():
-            self._stack_add(
-                tag,
-                WCfg.BACKGROUND,
-                attrs[HTML.Attrs.STYLE][HTML.Style.BACKGROUND_COLOR],
-            )
+        if WCfg.BACKGROUND in style:
+            props[WCfg.BACKGROUND] = style[WCfg.BACKGROUND]
         elif tag == HTML.Tag.MARK:
-            self._stack_add(tag, WCfg.BACKGROUND, "yellow")
+            props[WCfg.BACKGROUND] = "yellow"
         else:
-            self._stack_add(tag, WCfg.BACKGROUND)
+            props[WCfg.BACKGROUND] = None
 
         # -------------------------------------------------------------------------- [ FONT_FAMILY ]
         # font family
-        if HTML.Style.FONT_FAMILY in attrs[HTML.Attrs.STYLE].keys():
-            font_family = Defs.DEFAULT_TEXT_FONT_FAMILY
-            for f in attrs[HTML.Attrs.STYLE][HTML.Style.FONT_FAMILY].split(","):
-                f = f.strip()
-                if f in map(lambda f: f.lower(), font.families()):
-                    font_family = f
-                    break
-            self._stack_add(tag, Fnt.FAMILY, font_family)
+        if Fnt.FAMILY in style:
+            props[Fnt.FAMILY] = style[Fnt.FAMILY]
         elif tag in (HTML.Tag.PRE, HTML.Tag.CODE):
-            self._stack_add(tag, Fnt.FAMILY, self.PREFORMATTED_FONT_FAMILY)
+            props[Fnt.FAMILY] = self.PREFORMATTED_FONT_FAMILY
         else:
-            self._stack_add(tag, Fnt.FAMILY)
+            props[Fnt.FAMILY] = None
 
         # ---------------------------------------------------------------------------- [ FONT_SIZE ]
-        if HTML.Style.FONT_SIZE in attrs[HTML.Attrs.STYLE].keys():
-            size = Defs.FONT_SIZE
-            if attrs[HTML.Attrs.STYLE][HTML.Style.FONT_SIZE].endswith("px"):
-                if attrs[HTML.Attrs.STYLE][HTML.Style.FONT_SIZE][:-2].isdigit():
-                    size = int(attrs[HTML.Attrs.STYLE][HTML.Style.FONT_SIZE][:-2])
-            elif attrs[HTML.Attrs.STYLE][HTML.Style.FONT_SIZE].endswith(r"%"):
-                if attrs[HTML.Attrs.STYLE][HTML.Style.FONT_SIZE][:-1].isdigit():
-                    size = int(
-                        (
-                            int(attrs[HTML.Attrs.STYLE][HTML.Style.FONT_SIZE][:-1])
-                            * Defs.FONT_SIZE
-                        )
-                        / 100
-                    )
-            self._stack_add(tag, Fnt.SIZE, size)
+        if Fnt.SIZE in style:
+            props[Fnt.SIZE] = style[Fnt.SIZE]
         elif tag.startswith("h") and len(tag) == 2:
-            self._stack_add(tag, Fnt.SIZE, Defs.HEADINGS_FONT_SIZE[tag])
+            props[Fnt.SIZE] = Defs.HEADINGS_FONT_SIZE[tag]
         else:
-            self._stack_add(tag, Fnt.SIZE)
+            props[Fnt.SIZE] = None
 
         # --------------------------------------------------------------------------- [ TEXT_ALIGN ]
-        if (
-            HTML.Style.TEXT_ALIGN in attrs[HTML.Attrs.STYLE].keys()
-            and tag in HTML.TEXT_ALIGN_TAGS
-        ):
-            self._stack_add(
-                tag, WCfg.JUSTIFY, attrs[HTML.Attrs.STYLE][HTML.Style.TEXT_ALIGN]
-            )
+        if WCfg.JUSTIFY in style and tag in HTML.TEXT_ALIGN_TAGS:
+            props[WCfg.JUSTIFY] = style[WCfg.JUSTIFY]
         else:
-            self._stack_add(tag, WCfg.JUSTIFY)
+            props[WCfg.JUSTIFY] = None
 
         # ---------------------------------------------------------------------- [ TEXT_DECORATION ]
-        if HTML.Style.TEXT_DECORATION in attrs[HTML.Attrs.STYLE].keys():
+        if Fnt.UNDERLINE in style:
             if tag == HTML.Tag.STRONG:
-                self._stack_add(tag, Fnt.UNDERLINE, False)
-                self._stack_add(tag, Fnt.OVERSTRIKE, False)
-            elif (
-                HTML.StyleTextDecoration.UNDERLINE
-                in attrs[HTML.Attrs.STYLE][HTML.Style.TEXT_DECORATION]
-            ):
-                self._stack_add(tag, Fnt.UNDERLINE, True)
-                self._stack_add(tag, Fnt.OVERSTRIKE, False)
-            elif (
-                HTML.StyleTextDecoration.LINE_THROUGH
-                in attrs[HTML.Attrs.STYLE][HTML.Style.TEXT_DECORATION]
-            ):
-                self._stack_add(tag, Fnt.UNDERLINE, False)
-                self._stack_add(tag, Fnt.OVERSTRIKE, True)
+                props[Fnt.UNDERLINE] = False
+                props[Fnt.OVERSTRIKE] = False
             else:
-                self._stack_add(tag, Fnt.UNDERLINE)
-                self._stack_add(tag, Fnt.OVERSTRIKE)
+                props[Fnt.UNDERLINE] = style[Fnt.UNDERLINE]
+                props[Fnt.OVERSTRIKE] = style[Fnt.OVERSTRIKE]
         elif tag == HTML.Tag.A and attrs[HTML.Attrs.HREF]:
-            self._stack_add(tag, Fnt.UNDERLINE, True)
-            self._stack_add(tag, Fnt.OVERSTRIKE, False)
+            props[Fnt.UNDERLINE] = True
+            props[Fnt.OVERSTRIKE] = False
         elif tag == HTML.Tag.U:
-            self._stack_add(tag, Fnt.UNDERLINE, True)
-            self._stack_add(tag, Fnt.OVERSTRIKE, False)
+            props[Fnt.UNDERLINE] = True
+            props[Fnt.OVERSTRIKE] = False
         else:
-            self._stack_add(tag, Fnt.UNDERLINE)
-            self._stack_add(tag, Fnt.OVERSTRIKE)
+            props[Fnt.UNDERLINE] = None
+            props[Fnt.OVERSTRIKE] = None
+
+        return props
 
     def handle_starttag(self, tag, attrs):
         # ------------------------------------------------------------------------------------------
+        self._data_flush()
+        if self.stats is not None:
+            self.stats.nodes += 1
         tag = tag.lower()
+        if tag == HTML.Tag.STYLE:
+            # the css text is kept in self._data until </style>
+            self._in_style = True
+            return
         attrs = self._parse_attrs(attrs)
+        if self._stylesheets:
+            attrs[HTML.Attrs.STYLE] = self._css_styles(tag, attrs)
 
         if tag in HTML.STYLE_TAGS:
             # ---------------------------------------------------------------------- [ STYLED_TAGS ]
-            self._parse_styles(tag, attrs)
+            props = self._parse_styles(tag, attrs)
 
             if tag in (HTML.Tag.B, HTML.Tag.STRONG) or tag in HTML.HEADING_TAGS:
-                self._stack_add(tag, Fnt.WEIGHT, "bold")
+                props[Fnt.WEIGHT] = "bold"
 
             elif tag in (HTML.Tag.I, HTML.Tag.EM):
-                self._stack_add(tag, Fnt.SLANT, "italic")
+                props[Fnt.SLANT] = "italic"
 
             elif tag == HTML.Tag.A:
-                self._stack_add(tag, Bind.LINK, attrs[HTML.Attrs.HREF])
+                props[Bind.LINK] = attrs[HTML.Attrs.HREF]
 
             elif tag == HTML.Tag.OL:
                 # ---------------------------------------------------------------- [ ORDERED_LISTS ]
@@ -491,7 +953,7 @@ class HTMLTextParser(HTMLParser):
                 for i in range(len(self.list_tags)):
                     offset = 30 * (i + 1)
                     tabs += [offset, tk.RIGHT, offset + 5, tk.LEFT]
-                self._stack_add(tag, WCfg.TABS, tabs)
+                props[WCfg.TABS] = tuple(tabs)
 
             elif tag == HTML.Tag.UL:
                 # -------------------------------------------------------------- [ UNORDERED_LISTS ]
@@ -501,9 +963,11 @@ class HTMLTextParser(HTMLParser):
                 for i in range(len(self.list_tags)):
                     offset = 30 * (i + 1)
                     tabs += [offset, tk.RIGHT, offset + 5, tk.LEFT]
-                self._stack_add(tag, WCfg.TABS, tabs)
+                props[WCfg.TABS] = tuple(tabs)
+
+            self._stack_push(tag, props)
 
-            elif tag == HTML.Tag.LI:
+            if tag == HTML.Tag.LI:
                 level = len(self.list_tags)
                 if level:
                     self.list_tags[-1].add()
@@ -517,58 +981,28 @@ class HTMLTextParser(HTMLParser):
                     else:
                         line_index = "\t" + "\t\t" * (level - 1) + line_index + "\t"
 
-                    self._stack_add(tag, Fnt.UNDERLINE, False)
-                    self._stack_add(tag, Fnt.OVERSTRIKE, False)
+                    self._stack_push(tag, {Fnt.UNDERLINE: False, Fnt.OVERSTRIKE: False})
                     self._w_tags_add()
-                    self._w.insert(tk.INSERT, line_index)
-                    self._stack_pop(tag, Fnt.UNDERLINE)
-                    self._stack_pop(tag, Fnt.OVERSTRIKE)
+                    self._insert_text(line_index)
+                    self._stack_pop(tag)
 
             elif tag in (HTML.Tag.TH, HTML.Tag.TD):
-                    self._w.insert(tk.INSERT, "\t")
+                    self._insert_text("\t")
 
         elif tag == HTML.Tag.IMG and attrs[HTML.Attrs.SRC]:
             # -------------------------------------------------------------------- [ UNSTYLED_TAGS ]
-            image = None
-            # print(attrs[HTML.Attrs.SRC] , self.cached_images)
-            if attrs[HTML.Attrs.SRC].startswith(("https://", "ftp://", "http://")):
-                if attrs[HTML.Attrs.SRC] in self.cached_images.keys():
-                    image = deepcopy(self.cached_images[attrs[HTML.Attrs.SRC]])
-                else:
-                    try:
-                        image = Image.open(
-                            BytesIO(requests.get(attrs[HTML.Attrs.SRC]).content)
-                        )
-                        self.cached_images[attrs[HTML.Attrs.SRC]] = deepcopy(image)
-                    except:
-                        pass
-
-            if attrs[HTML.Attrs.SRC] in self.cached_images.keys():
-                image = deepcopy(self.cached_images[attrs[HTML.Attrs.SRC]])
-            elif os.path.exists(attrs[HTML.Attrs.SRC]):
-                image = Image.open(attrs[HTML.Attrs.SRC])
-                self.cached_images[attrs[HTML.Attrs.SRC]] = deepcopy(image)
-            if image:
-                width = image.size[0]
-                height = image.size[1]
-                resize = False
-                if str(attrs[HTML.Attrs.WIDTH]).isdigit():
-                    width = int(attrs[HTML.Attrs.WIDTH])
-                    resize = True
-                if str(attrs[HTML.Attrs.HEIGHT]).isdigit():
-                    height = int(attrs[HTML.Attrs.HEIGHT])
-                    resize = True
-                if resize:
-                    image = image.resize((width, height), Image.Resampling.LANCZOS)
-                self.images.append(ImageTk.PhotoImage(image))
-                self._w.image_create(tk.INSERT, image=self.images[-1])
+            width, height = None, None
+            if str(attrs[HTML.Attrs.WIDTH]).isdigit():
+                width = int(attrs[HTML.Attrs.WIDTH])
+            if str(attrs[HTML.Attrs.HEIGHT]).isdigit():
+                height = int(attrs[HTML.Attrs.HEIGHT])
+            self._insert_image((attrs[HTML.Attrs.SRC], width, height))
 
         elif tag == HTML.Tag.TABLE:
-                tabs = []
-                for i in range(30): # HF was len(self.list_tags)):
-                    offset = 40 * (i + 1)
-                    tabs += [offset, tk.LEFT ]
-                self._stack_add(tag, WCfg.TABS, tabs)
+            # -------------------------------------------------------------------------- [ TABLES ]
+            # the tab stops of the table are computed from its cells once rendered
+            self._stack_push(tag, {Layout.TABLE: self._table_count, WCfg.TABS: ()})
+            self._table_count += 1
 
         if self.strip:
             if tag == HTML.Tag.BR:
@@ -579,7 +1013,7 @@ class HTMLTextParser(HTMLParser):
         if (
             tag in HTML.NEW_LINE_TAGS
             and self.strip
-            and self._w.index("end-1c") != "1.0"
+            and not self._text_empty()
         ):
             if tag in (HTML.Tag.DIV,):
                 self._insert_new_line()
@@ -595,44 +1029,54 @@ class HTMLTextParser(HTMLParser):
 
     def handle_charref(self, data):
         # ------------------------------------------------------------------------------------------
+        self._data_flush()
         try:
             char = chr(int(data))
-            self._w.insert(tk.INSERT, char)
+            self._insert_text(char)
         except:
             pass
 
     def _insert_new_line(self, double=False):
         # ------------------------------------------------------------------------------------------
         self._remove_last_space()
-        if self._w.get("end-3c", "end-1c") == "\n\n":
+        if self._text_tail(2) == "\n\n":
             pass
-        elif self._w.get("end-2c", "end-1c") == "\n":
+        elif self._text_last() == "\n":
             if double:
-                self._w.insert(tk.INSERT, "\n")
+                self._insert_text("\n")
         elif double:
-            self._w.insert(tk.INSERT, "\n\n")
+            self._insert_text("\n\n")
         else:
-            self._w.insert(tk.INSERT, "\n")
+            self._insert_text("\n")
 
     def _text_rstrip(self):
         # ------------------------------------------------------------------------------------------
         for _ in range(3):
-            if self._w.get("end-2c", "end-1c") in (" ", "\n"):
-                self._w.delete("end-2c", "end-1c")
+            if self._text_last() in (" ", "\n"):
+                self._text_delete_last()
 
     def _remove_last_space(self):
         # ------------------------------------------------------------------------------------------
-        if self._w.get("end-2c", "end-1c") == " ":
-            self._w.delete("end-2c", "end-1c")
+        if self._text_last() == " ":
+            self._text_delete_last()
 
-    def _remove_multi_spaces(self, data):
+    def handle_data(self, data):
         # ------------------------------------------------------------------------------------------
-        data = data.replace("  ", " ")
-        if "  " in data:
-            data = self._remove_multi_spaces(data)
-        return data
+        # a text node may arrive in pieces when the html is fed in chunks, it is
+        # handled as a whole when the next tag starts or ends
+        self._data.append(data)
 
-    def handle_data(self, data):
+    def _data_flush(self):
+        # ------------------------------------------------------------------------------------------
+        if self._data and not self._in_style:
+            data = "".join(self._data)
+            self._data = []
+            self._handle_text(data)
+
+    def _handle_text(self, data):
+        # ------------------------------------------------------------------------------------------
+        if self.stats is not None:
+            self.stats.nodes += 1
         if HTML.Tag.PRE in self.html_tags:
             pass
         elif not data.strip():
@@ -640,56 +1084,47 @@ class HTMLTextParser(HTMLParser):
                 data = ""
         elif self.strip:
             # left strip
-            if self._w.index("end-1c").endswith(".0"):
-                data = data.lstrip()
-            elif self._w.get("end-2c", "end-1c") == " ":
+            if self._text_last() in ("", " ", "\n"):
                 data = data.lstrip()
 
-            data = data.replace("\n", " ").replace("\t", " ")
-            data = f"{data}" # FIXME: attaching a space in blind is wrong - SPACE REMOVED
-            data = self._remove_multi_spaces(data)
+            # new lines, tabs and spaces collapse to one space, in a single pass
+            data = Defs.WHITESPACE.sub(" ", data)
             if len(self.html_tags) and self.html_tags[-1] in (
                 HTML.Tag.UL,
                 HTML.Tag.OL,
             ):
-                self._w.insert(tk.INSERT, "\t" * 2 * len(self.list_tags))
+                self._insert_text("\t" * 2 * len(self.list_tags))
 
-        self._w.insert(tk.INSERT, data)
+        self._insert_text(data)
 
     def handle_endtag(self, tag):
         # ------------------------------------------------------------------------------------------
+        if self._in_style:
+            self._in_style = False
+            self._stylesheets += (css.compile_stylesheet("".join(self._data)),)
+            self._data = []
+            return
+        self._data_flush()
+        if self.stats is not None:
+            self.stats.nodes += 1
         tag = tag.lower()
 
-        try:
-            index = len(self.html_tags) - self.html_tags[::-1].index(tag) - 1
-            self.html_tags.pop(index)
-        except:
-            pass
-
-        if tag in HTML.STYLE_TAGS:
-            self._stack_pop(tag, WCfg.FOREGROUND)
-            self._stack_pop(tag, WCfg.BACKGROUND)
-            self._stack_pop(tag, WCfg.JUSTIFY)
-            self._stack_pop(tag, Fnt.FAMILY)
-            self._stack_pop(tag, Fnt.SIZE)
-            self._stack_pop(tag, Fnt.UNDERLINE)
-            self._stack_pop(tag, Fnt.OVERSTRIKE)
-
-            if tag == HTML.Tag.B or tag == HTML.Tag.STRONG or tag in HTML.HEADING_TAGS:
-                self._stack_pop(tag, Fnt.WEIGHT)
+        if self.html_tags and self.html_tags[-1] == tag:
+            self.html_tags.pop()
+        else:
+            try:
+                index = len(self.html_tags) - self.html_tags[::-1].index(tag) - 1
+                self.html_tags.pop(index)
+            except:
+                pass
 
-            elif tag in (HTML.Tag.I, HTML.Tag.EM):
-                self._stack_pop(tag, Fnt.SLANT)
+        if tag in HTML.STYLE_TAGS or tag == HTML.Tag.TABLE:
+            self._stack_pop(tag)
 
-            elif tag == HTML.Tag.A:
-                self._stack_pop(tag, Bind.LINK)
-
-            elif tag in (HTML.Tag.OL, HTML.Tag.UL):
+            if tag in (HTML.Tag.OL, HTML.Tag.UL):
                 if len(self.list_tags):
                     self.list_tags = self.list_tags[:-1]
 
-                self._stack_pop(tag, WCfg.TABS)
-
         if tag in HTML.NEW_LINE_TAGS and self.strip:
             self._insert_new_line()
 
@@ -702,49 +1137,1059 @@ class HTMLTextParser(HTMLParser):
             else:
                 self._insert_new_line(double=True)
 
-    def _w_tags_apply_all(self):
+    def _runs_end(self, hold_back):
         # ------------------------------------------------------------------------------------------
-        # update indexes
-        if self.strip:
-            self._text_rstrip()
-        end_index = tk.END
-        for key, tag in reversed(tuple(self._w_tags.items())):
-            tag[WTag.START_INDEX] = key
-            tag[WTag.END_INDEX] = end_index
-            end_index = key
-
-        # add tags
-        self.hlink_slots = []
-        for key, tag in self._w_tags.items():
+        """
+        (run index, text offset) of the end of the runs. With hold_back the trailing
+        spaces and new lines are left out, as the parser may still remove them.
+        """
+        runs = self.runs
+        end_run, end_offset = len(runs), 0
+        held = 0
+        while hold_back and held < 3 and end_run > 0:
+            kind, value, _ = runs[end_run - 1]
+            if kind != Run.TEXT:
+                break
+            count = min(len(value) - len(value.rstrip(" \n")), 3 - held)
+            if not count:
+                break
+            held += count
+            if count < len(value):
+                end_run, end_offset = end_run - 1, len(value) - count
+                break
+            end_run -= 1
+        return end_run, end_offset
+
+    def _runs_slice(self, start, end):
+        # ------------------------------------------------------------------------------------------
+        start_run, start_offset = start
+        end_run, end_offset = end
+        runs = []
+        for i in range(start_run, end_run + (1 if end_offset else 0)):
+            kind, value, key = self.runs[i]
+            if kind == Run.TEXT:
+                value = value[
+                    start_offset if i == start_run else 0 : end_offset if i == end_run else None
+                ]
+            runs.append((kind, value, key))
+        return runs
+
+    def _runs_blocks(self, runs):
+        # ------------------------------------------------------------------------------------------
+        """
+        Split runs into blocks, one per line of text, comparable across renders
+        """
+        blocks, block = [], []
+        for kind, value, key in self._w_runs_merged(runs):
+            if kind != Run.TEXT:
+                block.append((kind, value, key))
+                continue
+            lines = value.split("\n")
+            for line in lines[:-1]:
+                block.append((kind, line + "\n", key))
+                blocks.append(tuple(block))
+                block = []
+            if lines[-1]:
+                block.append((kind, lines[-1], key))
+        if block:
+            blocks.append(tuple(block))
+        return blocks
+
+    def _w_runs_take(self, hold_back):
+        # ------------------------------------------------------------------------------------------
+        """
+        Runs parsed since the last call
+        """
+        end = self._runs_end(hold_back)
+        if end <= self._applied:
+            return []
+        runs = self._runs_slice(self._applied, end)
+        self._applied = end
+        self.search_index.append("".join(v for kind, v, _ in runs if kind == Run.TEXT))
+        return runs
+
+    def _w_runs_merged(self, runs):
+        # ------------------------------------------------------------------------------------------
+        """
+        Yield runs with consecutive text of the same style joined together
+        """
+        texts, text_key = [], None
+        for kind, value, key in runs:
+            if kind == Run.TEXT and key == text_key:
+                texts.append(value)
+                continue
+            if texts:
+                yield Run.TEXT, "".join(texts), text_key
+                texts, text_key = [], None
+            if kind == Run.TEXT:
+                texts, text_key = [value], key
+            else:
+                yield kind, value, key
+        if texts:
+            yield Run.TEXT, "".join(texts), text_key
+
+    def _w_tags_apply(self, runs, line_start=False):
+        # ------------------------------------------------------------------------------------------
+        with self._profile("tags"):
+            fonts = len(_fonts)
+            new_keys = [
+                key
+                for key in dict.fromkeys(key for _, _, key in runs)
+                if key not in self._w_tags_applied
+            ]
+            changed = self._w_tables_measure(runs, line_start)
+            self._w_tags_config(new_keys)
+            # columns widened by the new rows of tables rendered before
+            for table in changed:
+                tabs = self._w_table_tabs(table)
+                for key in self._w_table_keys.get(table, ()):
+                    if key not in new_keys:
+                        self._w.tag_config(key, tabs=tabs)
+            if self.stats is not None:
+                self.stats.tags += len(new_keys)
+                self.stats.fonts += len(_fonts) - fonts
+
+    def _w_tags_config(self, keys):
+        # ------------------------------------------------------------------------------------------
+        # configure the tags used for the first time
+        for key in keys:
+            self._w_tags_applied.add(key)
+            tag = self._w_tags[key]
             if "config" in tag: # HF change justify to left for tkinter (only supports left, right, center)
                 if tag["config"].get("justify") == "justify":
                     tag["config"]["justify"] = "left"
-            self._w.tag_add(key, tag[WTag.START_INDEX], tag[WTag.END_INDEX])
-            self._w.tag_config(key, font=font.Font(**tag[Fnt.KEY]), **tag[WCfg.KEY])
-            if tag[Bind.KEY][Bind.LINK]:
-                self.hlink_slots.append(
-                    HLinkSlot(self._w, key, tag[Bind.KEY][Bind.LINK])
+            config = tag[WCfg.KEY]
+            table = tag[Layout.KEY][Layout.TABLE]
+            if table is not None and not config[WCfg.TABS]:
+                self._w_table_keys.setdefault(table, []).append(key)
+                config = dict(config, tabs=self._w_table_tabs(table))
+            self._w.tag_config(key, font=get_font(self._w, **tag[Fnt.KEY]), **config)
+            self.w_resources.add_font(self._w_font_key(key))
+            if tag[Bind.KEY][Bind.LINK] and Defs.LINK_TAG not in self._w_tags_applied:
+                self._w_tags_applied.add(Defs.LINK_TAG)
+                self._w_links_bind(self._w)
+
+    def _w_links_bind(self, w):
+        # ------------------------------------------------------------------------------------------
+        # the links share Defs.LINK_TAG, so the bindings do not grow with the links, and
+        # the link under the mouse is found from the tags of the character under it.
+        # The commands are registered once per widget and bound again to the tag once
+        # the widget tags have been deleted.
+        link = self._w_link_widgets.get(w)
+        if link is None:
+            link = self._w_link_widgets[w] = [
+                (
+                    w.register(lambda: self._w_link_click(w)),
+                    w.register(lambda: self._w_link_enter(w)),
+                    w.register(lambda: self._w_link_leave(w)),
+                ),
+                None,
+            ]
+        for sequence, command in zip(("<Button-1>", "<Enter>", "<Leave>"), link[0]):
+            w.tag_bind(Defs.LINK_TAG, sequence, command)
+
+    def _w_run_tags(self, key):
+        # ------------------------------------------------------------------------------------------
+        # tags of the text runs of the style key
+        return (key, Defs.LINK_TAG) if self._w_tags[key][Bind.KEY][Bind.LINK] else key
+
+    def _w_image_tag(self, key, name):
+        # ------------------------------------------------------------------------------------------
+        self._w.tag_add(key, name)
+        if self._w_tags[key][Bind.KEY][Bind.LINK]:
+            self._w.tag_add(Defs.LINK_TAG, name)
+
+    def _w_link_at(self, w, index):
+        # ------------------------------------------------------------------------------------------
+        """
+        (style key, url) of the link at index of the text widget w, (None, None)
+        if there is none
+        """
+        for key in reversed(w.tag_names(index)):
+            tag = self._w_tags.get(str(key))
+            if tag is not None and tag[Bind.KEY][Bind.LINK]:
+                return str(key), tag[Bind.KEY][Bind.LINK]
+        return None, None
+
+    def _w_link_click(self, w):
+        # ------------------------------------------------------------------------------------------
+        key, url = self._w_link_at(w, tk.CURRENT)
+        if url is not None:
+            self.link_handler(url)
+            w.tag_config(key, foreground="purple")
+
+    def _w_link_enter(self, w):
+        # ------------------------------------------------------------------------------------------
+        link = self._w_link_widgets[w]
+        if link[1] is None:
+            link[1] = str(w.cget("cursor"))
+        w.config(cursor=Defs.LINK_CURSOR)
+
+    def _w_link_leave(self, w):
+        # ------------------------------------------------------------------------------------------
+        link = self._w_link_widgets[w]
+        if link[1] is not None:
+            w.config(cursor=link[1])
+            link[1] = None
+
+    def _w_font_key(self, key):
+        # ------------------------------------------------------------------------------------------
+        # key in _fonts of the font of the style key
+        font_key = self._w_font_keys.get(key)
+        if font_key is None:
+            font_key = self._w_font_keys[key] = tuple(sorted(self._w_tags[key][Fnt.KEY].items()))
+        return font_key
+
+    def _w_text_width(self, key, text):
+        # ------------------------------------------------------------------------------------------
+        if not text:
+            return 0
+        font_key = self._w_font_key(key)
+        width = _text_widths.get((font_key, text))
+        if width is None:
+            if len(_text_widths) >= Defs.MEASURE_CACHE_SIZE:
+                _text_widths.clear()
+            width = _text_widths[font_key, text] = self.w_font(self._w, key).measure(text)
+        return width
+
+    def _w_tables_measure(self, runs, line_start=False):
+        # ------------------------------------------------------------------------------------------
+        """
+        Widen the columns of the tables of runs to fit their cells, and return the
+        tables whose columns changed. In a table every line is a row and every tab
+        starts a cell. With line_start runs are inserted at the start of a line.
+        """
+        changed = set()
+        if line_start:
+            for state in self._w_tables.values():
+                state[1:] = 0, 0
+        for kind, value, key in runs:
+            table = self._w_tags[key][Layout.KEY][Layout.TABLE]
+            if table is None:
+                continue
+            # [column widths, column, width of the cell so far], kept across calls
+            # as a row may be split between two of them
+            state = self._w_tables.get(table)
+            if state is None:
+                state = self._w_tables[table] = [[0], 0, 0]
+            widths, column, width = state
+            if kind == Run.IMAGE:
+                width += value[1] or Defs.IMAGE_PLACEHOLDER_SIZE[0]
+                value = ""
+            start = 0
+            for match in Layout.CELL_END.finditer(value):
+                width += self._w_text_width(key, value[start : match.start()])
+                if width > widths[column]:
+                    widths[column] = width
+                    changed.add(table)
+                if match.group() == "\t":
+                    column += 1
+                    if column == len(widths):
+                        # a new column, which needs one more tab stop
+                        widths.append(0)
+                        changed.add(table)
+                else:
+                    column = 0
+                width, start = 0, match.end()
+            width += self._w_text_width(key, value[start:])
+            state[1:] = column, width
+        return changed
+
+    def _w_table_tabs(self, table):
+        # ------------------------------------------------------------------------------------------
+        # the tab starting a column stops after the widest cell of the previous column
+        tabs, stop = [], 0
+        for width in self._w_tables.get(table, ([],))[0][:-1]:
+            stop += width + Defs.TABLE_CELL_SPACING
+            tabs.append(stop)
+        return tuple(tabs)
+
+    def _w_runs_apply(self, runs, index=tk.END):
+        # ------------------------------------------------------------------------------------------
+        # text runs between two images go to the widget in a single insert call
+        insert_args = []
+        for kind, value, key in self._w_runs_merged(runs):
+            if kind == Run.TEXT:
+                insert_args += (value, self._w_run_tags(key))
+                continue
+            if insert_args:
+                self._w_insert(index, insert_args)
+                insert_args = []
+            with self._profile("images"):
+                self._w_image_create(value, key, index)
+        if insert_args:
+            self._w_insert(index, insert_args)
+
+    def _w_insert(self, index, insert_args):
+        # ------------------------------------------------------------------------------------------
+        with self._profile("insert"):
+            self._w.insert(index, *insert_args)
+
+    def _w_image_create(self, image_ref, key, index=tk.END):
+        # ------------------------------------------------------------------------------------------
+        src, width, height = image_ref
+        image = self._cached_image(src, width, height)
+        resolver, size = None, None
+        if image is None:
+            try:
+                resolver, data = self._resolve_image(src)
+                if data is not None and self.lazy_images and not self._virtual:
+                    size = images.image_size(data, width, height)
+                elif data is not None:
+                    image = self._load_image(src, width, height, data)
+            except Exception:
+                # an src that cannot be resolved or decoded is left out, as a failed
+                # download is
+                resolver, image = None, None
+
+        if resolver is not None and resolver.remote:
+            future = images.fetch_image_async(
+                src, width, height, resolver.resolve, self._image_scope()
+            )
+            if not future.done():
+                # keep the place of the image until it is downloaded, see _w_images_poll
+                name = self._w_image_placeholder(key, index, width, height)
+                self._pending_images.append((future, name, src, width, height, self.stats))
+                if self.stats is not None:
+                    self.stats.images_pending += 1
+                return
+            image = self._image_result(future, src, width, height, self.stats)
+        elif size is not None:
+            # a placeholder of the size of the image until it is in view
+            name = self._w_image_placeholder(key, index, *size)
+            self._w_lazy_images[name] = image_ref
+            if self.stats is not None:
+                self.stats.images += 1
+            return
+
+        if image:
+            photo = self._w_photo(image_ref, image)
+            name = self._w.image_create(index, image=photo)
+            self._w_images[name] = photo
+            self._w_image_tag(key, name)
+            if self.stats is not None:
+                self.stats.images += 1
+
+    def _w_photo(self, image_ref, image):
+        # ------------------------------------------------------------------------------------------
+        # the images of the same (src, width, height) share a PhotoImage
+        photo = self._w_photos.get(image_ref)
+        if photo is None:
+            photo = self._w_photos[image_ref] = ImageTk.PhotoImage(image)
+            self.images.append(photo)
+            self.w_resources.add_image(photo)
+        return photo
+
+    def _w_image_placeholder(self, key, index, width, height):
+        # ------------------------------------------------------------------------------------------
+        width = width or Defs.IMAGE_PLACEHOLDER_SIZE[0]
+        height = height or Defs.IMAGE_PLACEHOLDER_SIZE[1]
+        placeholder = self._w_photos.get((None, width, height))
+        if placeholder is None:
+            placeholder = tk.PhotoImage(width=width, height=height)
+            self._w_photos[None, width, height] = placeholder
+            self.images.append(placeholder)
+            self.w_resources.add_image(placeholder)
+        name = self._w.image_create(index, image=placeholder)
+        self._w_images[name] = placeholder
+        self._w_image_tag(key, name)
+        return name
+
+    def _resolve_image(self, src):
+        # ------------------------------------------------------------------------------------------
+        """
+        (resolver, image data) of src from the first of self.image_resolvers that
+        has its image. The data of a remote resolver is None, it is resolved on the
+        download pool.
+        """
+        for resolver in self.image_resolvers:
+            if not resolver.accepts(src):
+                continue
+            if resolver.remote:
+                return resolver, None
+            data = resolver.resolve(src)
+            if data is not None:
+                return resolver, data
+        return None, None
+
+    def _image_scope(self):
+        # ------------------------------------------------------------------------------------------
+        """
+        Scope of the cached images and of the downloads of the parser: None when all
+        of self.image_resolvers are shared, else its resolvers that are not, so
+        parsers mapping the same src to different images do not get each other's
+        """
+        return tuple(r for r in self.image_resolvers if not r.shared) or None
+
+    def _load_image(self, src, width, height, data=None):
+        # ------------------------------------------------------------------------------------------
+        if data is None:
+            data = self._resolve_image(src)[1]
+            if data is None:
+                return None
+        image = images.open_image(data, width, height)
+        self.cached_images.put((self._image_scope(), src, width, height), image)
+        return image
+
+    def load_images(self, runs):
+        # ------------------------------------------------------------------------------------------
+        """
+        Decode the local images of runs into the image cache and start downloading
+        the remote ones, so rendering the runs later does not wait for them
+        """
+        for kind, value, _ in runs:
+            if kind != Run.IMAGE:
+                continue
+            src, width, height = value
+            if self._cached_image(src, width, height) is not None:
+                continue
+            try:
+                resolver, data = self._resolve_image(src)
+                if resolver is not None and resolver.remote:
+                    images.fetch_image_async(
+                        src, width, height, resolver.resolve, self._image_scope()
+                    )
+                elif data is not None:
+                    self._load_image(src, width, height, data)
+            except Exception:
+                # reported again when the image is rendered
+                pass
+
+    def _cached_image(self, src, width, height):
+        # ------------------------------------------------------------------------------------------
+        scope = self._image_scope()
+        image = self.cached_images.get((scope, src, width, height))
+        if image is None and (width or height):
+            image = self.cached_images.get((scope, src, None, None))
+            if image is not None:
+                image = images.resize_image(image, width, height)
+                self.cached_images.put((scope, src, width, height), image)
+        return image
+
+    def _image_result(self, future, src, width, height, stats=None):
+        # ------------------------------------------------------------------------------------------
+        if future.exception() is not None:
+            return None
+        image, nbytes = future.result()
+        if stats is not None and src not in stats.downloads:
+            # the images of the same src share a single download
+            stats.downloads.add(src)
+            stats.bytes_fetched += nbytes
+        self.cached_images.put((self._image_scope(), src, width, height), image)
+        return image
+
+    def _w_images_poll(self, w, pending):
+        # ------------------------------------------------------------------------------------------
+        if pending is not self._pending_images:
+            # a newer render replaced these images
+            return
+
+        done = [item for item in pending if item[0].done()]
+        pending[:] = [item for item in pending if not item[0].done()]
+        for future, name, src, width, height, stats in done:
+            start = time.perf_counter()
+            image = self._image_result(future, src, width, height, stats)
+            try:
+                if image:
+                    photo = self._w_photo((src, width, height), image)
+                    w.image_configure(name, image=photo)
+                    self._w_images[name] = photo
+                else:
+                    prev_state = w.cget("state")
+                    w.config(state=tk.NORMAL)
+                    w.delete(name)
+                    w.config(state=prev_state)
+            except tk.TclError:
+                if not w.winfo_exists():
+                    return
+                # else the image has been removed by a diff render
+
+            if stats is not None:
+                stats.timings["images"] += time.perf_counter() - start
+                stats.images_pending -= 1
+                stats.images += 1 if image else 0
+                if not stats.images_pending:
+                    self._stats_report(stats)
+
+        if pending:
+            w.after(Defs.IMAGE_POLL_INTERVAL, self._w_images_poll, w, pending)
+
+    def w_images_show(self, w):
+        # ------------------------------------------------------------------------------------------
+        """
+        Decode the images of the text widget w deferred by lazy_images that are in
+        view, or less than Defs.LAZY_IMAGE_MARGIN lines away from it
+        """
+        if not self._w_lazy_images:
+            return
+        margin = Defs.LAZY_IMAGE_MARGIN
+        first = w.index(f"@0,0 - {margin} lines linestart")
+        last = w.index(f"@0,{w.winfo_height()} + {margin} lines lineend")
+        for _, name, _ in w.dump(first, last, image=True):
+            image_ref = self._w_lazy_images.pop(name, None)
+            if image_ref is None:
+                continue
+            src, width, height = image_ref
+            try:
+                image = self._cached_image(src, width, height) or self._load_image(
+                    src, width, height
                 )
-                self._w.tag_bind(key, "<Button-1>", self.hlink_slots[-1].call)
-                self._w.tag_bind(key, "<Leave>", self.hlink_slots[-1].leave)
-                self._w.tag_bind(key, "<Enter>", self.hlink_slots[-1].enter)
+            except Exception:
+                image = None
+            if image:
+                photo = self._w_photo(image_ref, image)
+                w.image_configure(name, image=photo)
+                self._w_images[name] = photo
+            else:
+                prev_state = w.cget("state")
+                w.config(state=tk.NORMAL)
+                w.delete(name)
+                w.config(state=prev_state)
 
-    def w_set_html(self, w, html, strip):
+    def w_search(self, w, query, nocase=True, first_line=1):
         # ------------------------------------------------------------------------------------------
-        self._w = w
-        self.stack = deepcopy(DEFAULT_STACK)
-        self.stack[WCfg.KEY][WCfg.BACKGROUND].append(
-            ("__DEFAULT__", self._w.cget("background"))
+        """
+        Search query in the text rendered in the text widget w, highlight its matches
+        with the tag Defs.SEARCH_TAG and return their offsets in search_index. An
+        empty query clears the search. first_line is the line of the document on
+        the first line of w.
+        """
+        self._w_search = [query, nocase, None] if query else None
+        w.tag_config(Defs.SEARCH_TAG, background=Defs.SEARCH_BACKGROUND)
+        self.w_search_show(w, first_line, force=True)
+        return self.search_index.find(query, nocase)
+
+    def w_search_show(self, w, first_line=1, force=False):
+        # ------------------------------------------------------------------------------------------
+        """
+        Highlight the matches of the last w_search that are in view of the text
+        widget w, or less than Defs.SEARCH_MARGIN lines away from it, so the cost of
+        a search does not grow with the number of its matches
+        """
+        shown = self._w_search_shown
+        if self._w_search is None:
+            if shown is not None:
+                w.tag_remove(Defs.SEARCH_TAG, "1.0", tk.END)
+                self._w_search_shown = None
+            return
+        view = (
+            int(w.index("@0,0").split(".")[0]) + first_line - 1,
+            int(w.index(f"@0,{w.winfo_height()}").split(".")[0]) + first_line - 1,
         )
-        self.stack[Fnt.KEY][Fnt.FAMILY].append(
-            ("__DEFAULT__", self.DEFAULT_TEXT_FONT_FAMILY)
+        if not force and shown is not None and shown[0] <= view[0] and view[1] <= shown[1]:
+            return
+
+        query, nocase, _ = self._w_search
+        index = self.search_index
+        lines = int(w.index("end-1c").split(".")[0])
+        first = max(view[0] - Defs.SEARCH_MARGIN, first_line)
+        last = min(view[1] + Defs.SEARCH_MARGIN, first_line + lines - 1)
+        matches = index.find(query, nocase)
+        ranges = []
+        for offset in matches[
+            bisect_left(matches, index.line_offset(first)) : bisect_left(
+                matches, index.line_offset(last + 1)
+            )
+        ]:
+            ranges += self.search_range(offset, first_line)
+        w.tag_remove(Defs.SEARCH_TAG, "1.0", tk.END)
+        if ranges:
+            w.tag_add(Defs.SEARCH_TAG, *ranges)
+            w.tag_raise(Defs.SEARCH_TAG)
+        self._w_search_shown = (first, last)
+
+    def w_search_next(self, w, backwards=False, first_line=1):
+        # ------------------------------------------------------------------------------------------
+        """
+        Offset in search_index of the match of the last w_search after the current
+        one, or before it with backwards, wrapping around. The first one is searched
+        from the top of the view of the text widget w. None without matches.
+        """
+        if self._w_search is None:
+            return None
+        query, nocase, current = self._w_search
+        matches = self.search_index.find(query, nocase)
+        if not matches:
+            return None
+        if current is None:
+            line, column = w.index("@0,0").split(".")
+            line = int(line)
+            count = w.count(f"{line}.0", f"{line}.{column}", "chars") if int(column) else 0
+            if isinstance(count, tuple):
+                count = count[0]
+            current = self.search_index.line_offset(line + first_line - 1) + (count or 0)
+            # a match at the top of the view is the next one
+            current -= not backwards
+        if backwards:
+            i = bisect_left(matches, current) - 1
+        else:
+            i = bisect_right(matches, current) % len(matches)
+        self._w_search[2] = matches[i]
+        return matches[i]
+
+    def search_range(self, offset, first_line=1):
+        # ------------------------------------------------------------------------------------------
+        """
+        Text widget indices of the start and end of the match of the last w_search
+        at offset. Images are not counted in the columns of search_index, the start
+        is found from the end of its first character so it is after the images
+        before it.
+        """
+        line, column = self.search_index.line_column(offset)
+        end_line, end_column = self.search_index.line_column(offset + len(self._w_search[0]))
+        return (
+            f"{line - first_line + 1}.0 + {column + 1} any chars - 1 indices",
+            f"{end_line - first_line + 1}.0 + {end_column} any chars",
         )
-        self._w_tags = OrderedDict()
+
+    @contextmanager
+    def _profile(self, phase):
+        # ------------------------------------------------------------------------------------------
+        if self.stats is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stats.timings[phase] += time.perf_counter() - start
+
+    def _stats_begin(self):
+        # ------------------------------------------------------------------------------------------
+        self.stats = RenderStats() if self.profile else None
+
+    def _stats_report(self, stats=None):
+        # ------------------------------------------------------------------------------------------
+        stats = self.stats if stats is None else stats
+        if stats is not None:
+            for callback in self.stats_callbacks:
+                callback(stats)
+
+    def _parse_feed(self, html, close=False):
+        # ------------------------------------------------------------------------------------------
+        with self._profile("parse"):
+            self.feed(html)
+            if close:
+                self.close()
+                self._data_flush()
+
+    def parse_begin(self, strip=True, background="white"):
+        # ------------------------------------------------------------------------------------------
+        """
+        Start parsing a new document, fed with feed() and finished with parse_end()
+        """
+        # one (tag, props, computed style) frame per open element
+        style = DEFAULT_STYLE._replace(
+            background=background, family=self.DEFAULT_TEXT_FONT_FAMILY
+        )
+        self.stack = [("__DEFAULT__", {}, style)]
+        self.runs = []
+        # (run index, text offset) of the end of the runs already applied to a widget
+        self._applied = (0, 0)
+        self._w_trim = 0
         self.html_tags = []
-        self.images = []
         self.list_tags = []
+        self._table_count = 0
+        self._data = []
+        # compiled stylesheets in cascade order, the <style> elements follow self.stylesheet
+        self._stylesheets = (self.stylesheet,) if self.stylesheet else ()
+        self._in_style = False
         self.strip = strip
         self._w_tags_add()
+        self.reset()
+
+    def parse_end(self):
+        # ------------------------------------------------------------------------------------------
+        self.close()
+        self._data_flush()
+        if self.strip:
+            self._text_rstrip()
+
+    def parse(self, html, strip=True, background="white"):
+        # ------------------------------------------------------------------------------------------
+        """
+        Parse html into self.runs, a list of (kind, value, style key) tuples, and
+        self._w_tags, the styles referenced by the runs. No widget is needed.
+        """
+        self.parse_begin(strip=strip, background=background)
         self.feed(html)
-        self._w_tags_apply_all()
+        self.parse_end()
+
+    def parse_document(self, html, strip=True):
+        # ------------------------------------------------------------------------------------------
+        """
+        Parse html into a Document, see parse_html
+        """
+        self.parse(html, strip=strip, background=None)
+        return self._document()
+
+    def _document(self):
+        # ------------------------------------------------------------------------------------------
+        styles = {key: style for style, key in self._w_styles.items()}
+        indexes = {}
+        runs = []
+        for kind, value, key in self.runs:
+            index = indexes.setdefault(key, len(indexes))
+            runs.append((kind, value, index))
+        return Document(tuple(runs), tuple(styles[key] for key in indexes), self.strip)
+
+    def _document_runs(self, document, background):
+        # ------------------------------------------------------------------------------------------
+        keys = [
+            self._style_key_of(style._replace(background=background))
+            if style.background is None
+            else self._style_key_of(style)
+            for style in document.styles
+        ]
+        # tables parsed later must not share the layout of the tables of the document
+        self._table_count = 1 + max(
+            (style.table for style in document.styles if style.table is not None), default=-1
+        )
+        return [(kind, value, keys[index]) for kind, value, index in document.runs]
+
+    def _parse_html(self, html, strip, background):
+        # ------------------------------------------------------------------------------------------
+        """
+        Parse html as parse_begin, feed and close do, from the plan cache if possible
+        """
+        key = None
+        if self.plan_cache is not None:
+            key = (
+                hashlib.blake2b(html.encode(), digest_size=16).digest(),
+                strip,
+                self.DEFAULT_TEXT_FONT_FAMILY,
+                self.PREFORMATTED_FONT_FAMILY,
+                Defs.FONT_SIZE,
+                background,
+                self.stylesheet.key if self.stylesheet else None,
+            )
+            plan = self.plan_cache.get(key)
+            if plan is not None:
+                self.parse_begin(strip=strip, background=background)
+                self.runs = self._document_runs(plan.document, background)
+                self.stack = list(plan.stack)
+                self.html_tags = list(plan.html_tags)
+                self._stylesheets = plan.stylesheets
+                self._w_tags_add()
+                return
+
+        self.parse_begin(strip=strip, background=background)
+        self._parse_feed(html, close=True)
+        # open lists keep a mutable item counter, their state is not cached
+        if key is not None and not self.list_tags and not self._in_style:
+            plan = Plan(
+                self._document(),
+                tuple(self.stack),
+                tuple(self.html_tags),
+                self._stylesheets,
+            )
+            self.plan_cache.put(key, plan)
+
+    def _w_apply_runs(self, runs, index=tk.END):
+        # ------------------------------------------------------------------------------------------
+        polling = bool(self._pending_images)
+        if self.stats is not None:
+            self.stats.runs += len(runs)
+        self._w_tags_apply(runs, line_start=index != tk.END)
+        self._w_runs_apply(runs, index)
+        self._w_search_shown = None
+        if self._pending_images and not polling:
+            self._w.after(
+                Defs.IMAGE_POLL_INTERVAL, self._w_images_poll, self._w, self._pending_images
+            )
+
+    def _w_apply_pending(self, hold_back=False):
+        # ------------------------------------------------------------------------------------------
+        if self._w_trim:
+            self._w.delete(f"end-{self._w_trim + 1}c", "end-1c")
+            self._w_trim = 0
+
+        self._w_apply_runs(self._w_runs_take(hold_back))
+
+    def _w_reset(self):
+        # ------------------------------------------------------------------------------------------
+        """
+        Start a new render, and return the RenderResources of the previous one, to
+        be released once the new render holds the fonts they share
+        """
+        resources, self.w_resources = self.w_resources, RenderResources()
+        self.images = []
+        self._w_images = {}
+        self._w_photos = {}
+        self._pending_images = []
+        self._w_lazy_images = {}
+        self._w_tags_applied = set()
+        self._w_tables = {}
+        self._w_table_keys = {}
+        self._applied = (0, 0)
+        self._w_trim = 0
+        self._virtual = False
+        self.search_index.clear()
+        self._w_search = None
+        self._w_search_shown = None
+        return resources
+
+    def _w_styles_prune(self):
+        # ------------------------------------------------------------------------------------------
+        # forget the styles that the runs of the new render do not use, their tags
+        # have been deleted from the widget
+        keys = {key for _, _, key in self.runs}
+        keys.add(self._style_key)
+        self._w_tags = OrderedDict((k, t) for k, t in self._w_tags.items() if k in keys)
+        self._w_styles = {s: k for s, k in self._w_styles.items() if k in keys}
+        self._w_font_keys = {k: f for k, f in self._w_font_keys.items() if k in keys}
+
+    def w_release(self, w):
+        # ------------------------------------------------------------------------------------------
+        """
+        Release the fonts, images and commands of the render in the text widget w,
+        before it is destroyed
+        """
+        self._pending_images = []
+        self._w_lazy_images = {}
+        self._w_images = {}
+        self._w_photos = {}
+        self.images = []
+        self.w_resources.release()
+        self._w_link_widgets.pop(w, None)
+
+    def w_resource_counts(self, w):
+        # ------------------------------------------------------------------------------------------
+        """
+        Counts of the resources alive for the text widget w, which stay flat when
+        the same html is rendered again and again
+        """
+        return {
+            "tk_images": len(w.tk.call("image", "names")),
+            "tk_fonts": len(font.names(w)),
+            "tcl_commands": len(w._tclCommands or ()),
+            "styles": len(self._w_tags),
+            "fonts": len(self.w_resources.fonts),
+            "images": len(self.w_resources.images),
+        }
+
+    def _w_images_prune(self, w):
+        # ------------------------------------------------------------------------------------------
+        # forget the images of the removed lines
+        embedded = set(map(str, w.image_names()))
+        self._w_images = {n: i for n, i in self._w_images.items() if n in embedded}
+        self._w_lazy_images = {
+            n: ref for n, ref in self._w_lazy_images.items() if n in embedded
+        }
+        self.images = list(dict.fromkeys(self._w_images.values()))
+        kept = set(self.images)
+        self._w_photos = {ref: i for ref, i in self._w_photos.items() if i in kept}
+        self.w_resources.release_images(self.w_resources.images - kept)
+
+    def w_apply(self, w, hold_back=False):
+        # ------------------------------------------------------------------------------------------
+        """
+        Apply the result of the last parse to the text widget w
+        """
+        self._w = w
+        resources = self._w_reset()
+        self._w_styles_prune()
+        self._w_apply_pending(hold_back)
+        resources.release()
         del self._w
+
+    def w_set_html(self, w, html, strip):
+        # ------------------------------------------------------------------------------------------
+        # the trailing spaces are held back instead of stripped, in case more html is appended
+        self._stats_begin()
+        self._parse_html(html, strip, w.cget("background"))
+        self.w_apply(w, hold_back=strip)
+        self._stats_report()
+
+    def parse_document_async(self, html, strip=True, processes=False):
+        # ------------------------------------------------------------------------------------------
+        """
+        Future of the Document of html, parsed on a worker thread, or on a worker
+        process with processes. The images of the document are decoded on the worker
+        thread. The parser state is left untouched, render the document from the Tk
+        thread with w_set_document.
+        """
+        return get_parse_executor().submit(self._parse_document_job, html, strip, processes)
+
+    def _parse_document_job(self, html, strip, processes):
+        # ------------------------------------------------------------------------------------------
+        stylesheet = self.stylesheet.text if self.stylesheet else None
+        if processes:
+            document = (
+                get_parse_executor(processes=True)
+                .submit(parse_html, html, strip, stylesheet)
+                .result()
+            )
+        else:
+            document = parse_html(html, strip=strip, stylesheet=stylesheet)
+        self.load_images(document.runs)
+        return document
+
+    def w_set_document(self, w, document):
+        # ------------------------------------------------------------------------------------------
+        """
+        Render a Document in the text widget w. Html appended later is parsed as if
+        no element was left open.
+        """
+        self._stats_begin()
+        background = w.cget("background")
+        self.parse_begin(strip=document.strip, background=background)
+        self.runs = self._document_runs(document, background)
+        self.w_apply(w)
+        self._stats_report()
+
+    def w_diff_html(self, w, html, strip):
+        # ------------------------------------------------------------------------------------------
+        """
+        Render html in the text widget w, replacing only the lines that differ from
+        the text rendered by the previous call. The unchanged lines keep their tags,
+        images and links.
+        """
+        if self.runs is None or self._w_trim or self._virtual:
+            return self.w_set_html(w, html, strip)
+
+        self._stats_begin()
+        old_blocks = self._runs_blocks(self._runs_slice((0, 0), self._applied))
+        self._parse_html(html, strip, w.cget("background"))
+        self._applied = self._runs_end(hold_back=strip)
+        runs = self._runs_slice((0, 0), self._applied)
+        self.search_index.clear()
+        self.search_index.append("".join(v for kind, v, _ in runs if kind == Run.TEXT))
+
+        self._w = w
+        with self._profile("diff"):
+            new_blocks = self._runs_blocks(runs)
+            changes = diff_blocks(old_blocks, new_blocks)
+        # from the end, so the line numbers of the blocks before stay valid
+        for i1, i2, j1, j2 in reversed(changes):
+            if i1 < i2:
+                w.delete(f"{i1 + 1}.0", f"{i2 + 1}.0")
+            if j1 < j2:
+                w.mark_set(Defs.DIFF_MARK, f"{i1 + 1}.0")
+                self._w_apply_runs(
+                    [run for block in new_blocks[j1:j2] for run in block], Defs.DIFF_MARK
+                )
+
+        self._w_images_prune(w)
+        del self._w
+        self._stats_report()
+
+    def w_begin(self, w, strip=True):
+        # ------------------------------------------------------------------------------------------
+        """
+        Start an empty document in the text widget w, see w_append_html
+        """
+        self._stats_begin()
+        self.parse_begin(strip=strip, background=w.cget("background"))
+        self.w_apply(w)
+
+    def w_append_html(self, w, html, flush=True):
+        # ------------------------------------------------------------------------------------------
+        """
+        Render html at the end of the text widget w, keeping the parser state left
+        by the previous call. Only the newly parsed runs are applied. Without flush
+        html may end in the middle of a text node, as chunks of a stream do.
+        """
+        if self.runs is None:
+            self.w_begin(w)
+        self._w = w
+        with self._profile("parse"):
+            self.feed(html)
+            if flush:
+                self._data_flush()
+        self._w_apply_pending(hold_back=self.strip)
+        del self._w
+        if flush:
+            self._stats_report()
+
+    def w_end(self, w):
+        # ------------------------------------------------------------------------------------------
+        """
+        Finish the document appended to the text widget w
+        """
+        self._w = w
+        with self._profile("parse"):
+            self.parse_end()
+        self._w_apply_pending()
+        del self._w
+        self._stats_report()
+
+    def w_virtual_begin(self, w, html, strip):
+        # ------------------------------------------------------------------------------------------
+        """
+        Parse html for the text widget w without rendering it, and return its
+        blocks, one per line of text, to be rendered with w_virtual_insert
+        """
+        self._stats_begin()
+        self.parse_begin(strip=strip, background=w.cget("background"))
+        self._parse_feed(html, close=True)
+        self._w_reset().release()
+        self._w_styles_prune()
+        self._virtual = True
+        # number of the complete blocks taken, and the runs of the last one if it is
+        # not complete, see _virtual_blocks_take
+        self._virtual_lines = 0
+        self._virtual_line = []
+        self._stats_report()
+        return self._virtual_blocks_take()[1]
+
+    def w_virtual_append(self, html):
+        # ------------------------------------------------------------------------------------------
+        """
+        Parse html after the document of w_virtual_begin and return (first, blocks),
+        the blocks replacing the blocks of the document from first on. Only the
+        newly parsed runs are split into blocks.
+        """
+        with self._profile("parse"):
+            self.feed(html)
+            self._data_flush()
+        return self._virtual_blocks_take()
+
+    def _virtual_blocks_take(self):
+        # ------------------------------------------------------------------------------------------
+        # the runs are taken as if applied, so the search index holds the whole document
+        runs = self._w_runs_take(hold_back=self.strip)
+        if self._w_trim:
+            # characters of the blocks already taken were removed, split them all again
+            self._w_trim = 0
+            self._virtual_lines, self._virtual_line = 0, []
+            runs = self._runs_slice((0, 0), self._applied)
+        first = self._virtual_lines
+        blocks = self._runs_blocks(self._virtual_line + runs)
+        kind, value, _ = blocks[-1][-1] if blocks else (Run.TEXT, "\n", None)
+        if kind != Run.TEXT or not value.endswith("\n"):
+            self._virtual_line = list(blocks[-1])
+            self._virtual_lines += len(blocks) - 1
+        else:
+            self._virtual_line = []
+            self._virtual_lines += len(blocks)
+        return first, blocks
+
+    def w_virtual_insert(self, w, blocks, index=tk.END):
+        # ------------------------------------------------------------------------------------------
+        """
+        Render blocks at index of the text widget w
+        """
+        self._w = w
+        if index != tk.END:
+            w.mark_set(Defs.VIRTUAL_MARK, index)
+            index = Defs.VIRTUAL_MARK
+        self._w_apply_runs([run for block in blocks for run in block], index)
+        del self._w
+
+    def w_virtual_delete(self, w, index1, index2):
+        # ------------------------------------------------------------------------------------------
+        """
+        Remove the blocks between index1 and index2 of the text widget w, and
+        release their images
+        """
+        w.delete(index1, index2)
+        self._w_images_prune(w)
+        self._w_search_shown = None
+
+    def w_font(self, w, key):
+        # ------------------------------------------------------------------------------------------
+        """
+        Font of the text of the style key, for the text widget w
+        """
+        return get_font(w, **self._w_tags[key][Fnt.KEY])
@@ -0,0 +1,507 @@
+"""
+Image loading
+"""
+import os
+import json
+import time
+import hashlib
+import binascii
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from io import BytesIO
+from urllib.parse import unquote_to_bytes
+from PIL import Image
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+REMOTE_SCHEMES = ("https://", "ftp://", "http://")
+MAX_WORKERS = 4
+TIMEOUT = 10
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+# images shrunk more than this many times are first reduced by an integer factor
+REDUCING_GAP = 2.0
+
+_executor = None
+# futures of the downloads by (scope, url), and of the decoded images by
+# (scope, url, width, height), see fetch_image_async
+_in_flight = {}
+_decoding = {}
+_lock = threading.RLock()
+_session = None
+
+# on-disk cache of downloaded image bytes, disabled unless set_disk_cache is called
+disk_cache = None
+
+
+# __________________________________________________________________________________________________
+# functions
+def is_remote(src):
+    # ------------------------------------------------------------------------------------------
+    return src.startswith(REMOTE_SCHEMES)
+
+
+def get_session():
+    # ------------------------------------------------------------------------------------------
+    """
+    requests.Session shared by every download, so connections are kept alive
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+    return _session
+
+
+def set_disk_cache(directory):
+    # ------------------------------------------------------------------------------------------
+    """
+    Keep downloaded images in directory across runs, None disables the cache
+    """
+    global disk_cache
+    disk_cache = None if directory is None else DiskCache(directory)
+
+
+def fetch_bytes(url):
+    # ------------------------------------------------------------------------------------------
+    """
+    Content at url, served from the disk cache while it is fresh and revalidated
+    with a conditional request once it is stale
+    """
+    cache = disk_cache
+    entry = cache.load(url) if cache else None
+    if entry and entry.is_fresh():
+        return entry.content
+
+    headers = entry.validators() if entry else {}
+    response = get_session().get(url, headers=headers, timeout=TIMEOUT)
+    if entry and response.status_code == 304:
+        headers = CaseInsensitiveDict(entry.headers)
+        headers.update(response.headers)
+        cache.store(url, headers, entry.content)
+        return entry.content
+
+    response.raise_for_status()
+    if cache:
+        cache.store(url, response.headers, response.content)
+    return response.content
+
+
+def target_size(size, width=None, height=None):
+    # ------------------------------------------------------------------------------------------
+    return width or size[0], height or size[1]
+
+
+def _image_file(data):
+    # ------------------------------------------------------------------------------------------
+    # bytes-like objects are read in place, BytesIO does not copy them until written
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return BytesIO(data)
+    return data
+
+
+def image_size(data, width=None, height=None):
+    # ------------------------------------------------------------------------------------------
+    """
+    Size of the image of data, as returned by a resolver, once resized to width and
+    height. Only the header of the image is read.
+    """
+    if isinstance(data, Image.Image):
+        return target_size(data.size, width, height)
+    with Image.open(_image_file(data)) as image:
+        return target_size(image.size, width, height)
+
+
+def open_image(data, width=None, height=None):
+    # ------------------------------------------------------------------------------------------
+    """
+    Decode the image of data, as returned by a resolver, resized to width and height.
+    JPEG images are decoded at the smallest scale larger than the requested size.
+    """
+    if isinstance(data, Image.Image):
+        return resize_image(data, width, height)
+    image = Image.open(_image_file(data))
+    if width or height:
+        image.draft(image.mode, target_size(image.size, width, height))
+    image.load()
+    return resize_image(image, width, height)
+
+
+def _get_executor():
+    # ------------------------------------------------------------------------------------------
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=MAX_WORKERS, thread_name_prefix="tkhtmlview-image"
+            )
+    return _executor
+
+
+def fetch_bytes_async(url, fetch=fetch_bytes, scope=None):
+    # ------------------------------------------------------------------------------------------
+    """
+    Future of fetch(url), the content at url, run on a bounded thread pool.
+    Requests for a url that is already being downloaded in the same scope share
+    the same future.
+    """
+    key = (scope, url)
+    with _lock:
+        future = _in_flight.get(key)
+        if future is None:
+            future = _in_flight[key] = _get_executor().submit(fetch, url)
+            future.add_done_callback(lambda f: _forget(_in_flight, key, f))
+    return future
+
+
+def fetch_image_async(url, width=None, height=None, fetch=fetch_bytes, scope=None):
+    # ------------------------------------------------------------------------------------------
+    """
+    Future of (image resized to width and height, downloaded size in bytes) for
+    url, downloaded with fetch and decoded on a bounded thread pool. The sizes of
+    a url share a single download, and requests for the same size the same future.
+    Only requests of the same scope are shared, None unless fetch may give another
+    image than fetch_bytes for url.
+    """
+    key = (scope, url, width, height)
+    with _lock:
+        future = _decoding.get(key)
+        if future is None:
+            future = _decoding[key] = Future()
+            future.add_done_callback(lambda f: _forget(_decoding, key, f))
+            fetch_bytes_async(url, fetch, scope).add_done_callback(
+                lambda f: _get_executor().submit(_decode_async, future, f, width, height)
+            )
+    return future
+
+
+def _decode_async(future, data_future, width, height):
+    # ------------------------------------------------------------------------------------------
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        data = data_future.result()
+        nbytes = len(data) if isinstance(data, (bytes, bytearray, memoryview)) else 0
+        future.set_result((open_image(data, width, height), nbytes))
+    except Exception as e:
+        future.set_exception(e)
+
+
+def _forget(futures, key, future):
+    # ------------------------------------------------------------------------------------------
+    with _lock:
+        if futures.get(key) is future:
+            del futures[key]
+
+
+def resize_image(image, width=None, height=None):
+    # ------------------------------------------------------------------------------------------
+    """
+    Resize image to the requested width and height, a missing one keeps its size
+    """
+    size = target_size(image.size, width, height)
+    if size == image.size:
+        return image
+    return image.resize(size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+
+
+def image_nbytes(image):
+    # ------------------------------------------------------------------------------------------
+    return image.size[0] * image.size[1] * len(image.getbands())
+
+
+def default_resolvers():
+    # ------------------------------------------------------------------------------------------
+    """
+    Resolvers of data: URIs, local files and remote urls, in that order
+    """
+    return [DataURIResolver(), FileResolver(), RemoteResolver()]
+
+
+# __________________________________________________________________________________________________
+# classes
+class ImageCache:
+    # ----------------------------------------------------------------------------------------------
+    """
+    Decoded images keyed by (scope, src, width, height), evicted in least recently
+    used order once their total size exceeds max_bytes. Images are shared, not
+    copied, so they must not be modified in place.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        # ------------------------------------------------------------------------------------------
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self.nbytes = 0
+
+    @property
+    def max_bytes(self):
+        # ------------------------------------------------------------------------------------------
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        # ------------------------------------------------------------------------------------------
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    def get(self, key):
+        # ------------------------------------------------------------------------------------------
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        # ------------------------------------------------------------------------------------------
+        nbytes = image_nbytes(image)
+        with self._lock:
+            if key in self._images:
+                self.nbytes -= image_nbytes(self._images.pop(key))
+            if nbytes > self._max_bytes:
+                return
+            self._images[key] = image
+            self.nbytes += nbytes
+            self._evict()
+
+    def clear(self):
+        # ------------------------------------------------------------------------------------------
+        with self._lock:
+            self._images.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        # ------------------------------------------------------------------------------------------
+        while self.nbytes > self._max_bytes:
+            _, image = self._images.popitem(last=False)
+            self.nbytes -= image_nbytes(image)
+
+    def __contains__(self, key):
+        # ------------------------------------------------------------------------------------------
+        return key in self._images
+
+    def __len__(self):
+        # ------------------------------------------------------------------------------------------
+        return len(self._images)
+
+
+class ImageResolver:
+    # ----------------------------------------------------------------------------------------------
+    """
+    Finds the image of an img src. resolve returns the image as a bytes-like object,
+    a path or binary file object, a PIL image, or None if it has none for src. The
+    resolvers of a parser are tried in order, the ones that accept src only.
+    Remote resolvers are run on the download pool, and are not tried further.
+    The images of shared resolvers depend on src only, so they are cached across
+    parsers, the others are cached for the parsers using the resolver.
+    """
+
+    remote = False
+    shared = False
+
+    def accepts(self, src):
+        # ------------------------------------------------------------------------------------------
+        return True
+
+    def resolve(self, src):
+        # ------------------------------------------------------------------------------------------
+        raise NotImplementedError
+
+
+class DataURIResolver(ImageResolver):
+    # ----------------------------------------------------------------------------------------------
+    """
+    Images inlined in data: URIs, base64 or percent encoded
+    """
+
+    shared = True
+
+    def accepts(self, src):
+        # ------------------------------------------------------------------------------------------
+        return src.startswith("data:")
+
+    def resolve(self, src):
+        # ------------------------------------------------------------------------------------------
+        uri = src.encode()
+        comma = uri.find(b",")
+        if comma < 0:
+            return None
+        # decoded from a view of the payload, without copying it out of the uri first
+        payload = memoryview(uri)[comma + 1 :]
+        if uri[:comma].endswith(b";base64"):
+            return binascii.a2b_base64(payload)
+        return unquote_to_bytes(bytes(payload))
+
+
+class FileResolver(ImageResolver):
+    # ----------------------------------------------------------------------------------------------
+    """
+    Images in local files, src is their path
+    """
+
+    shared = True
+
+    def accepts(self, src):
+        # ------------------------------------------------------------------------------------------
+        return not is_remote(src) and os.path.exists(src)
+
+    def resolve(self, src):
+        # ------------------------------------------------------------------------------------------
+        return src
+
+
+class RemoteResolver(ImageResolver):
+    # ----------------------------------------------------------------------------------------------
+    """
+    Images downloaded from http, https and ftp urls, see fetch_bytes
+    """
+
+    remote = True
+    shared = True
+
+    def accepts(self, src):
+        # ------------------------------------------------------------------------------------------
+        return is_remote(src)
+
+    def resolve(self, src):
+        # ------------------------------------------------------------------------------------------
+        return fetch_bytes(src)
+
+
+class MappingResolver(ImageResolver):
+    # ----------------------------------------------------------------------------------------------
+    """
+    Images provided by the application, from a mapping of src to image or a
+    callable returning the image of src or None, so they need no file nor download
+    """
+
+    def __init__(self, provider):
+        # ------------------------------------------------------------------------------------------
+        self.provider = provider
+
+    def accepts(self, src):
+        # ------------------------------------------------------------------------------------------
+        return callable(self.provider) or src in self.provider
+
+    def resolve(self, src):
+        # ------------------------------------------------------------------------------------------
+        if callable(self.provider):
+            return self.provider(src)
+        return self.provider.get(src)
+
+
+class DiskCacheEntry:
+    # ----------------------------------------------------------------------------------------------
+    def __init__(self, headers, content, stored_at):
+        # ------------------------------------------------------------------------------------------
+        self.headers = headers
+        self.content = content
+        self.stored_at = stored_at
+
+    def _cache_control(self):
+        # ------------------------------------------------------------------------------------------
+        directives = {}
+        for directive in self.headers.get("Cache-Control", "").lower().split(","):
+            name, _, value = directive.strip().partition("=")
+            if name:
+                directives[name] = value.strip('"')
+        return directives
+
+    def storable(self):
+        # ------------------------------------------------------------------------------------------
+        return "no-store" not in self._cache_control()
+
+    def freshness_lifetime(self):
+        # ------------------------------------------------------------------------------------------
+        cache_control = self._cache_control()
+        if "no-cache" in cache_control:
+            return 0
+        if cache_control.get("max-age", "").isdigit():
+            return int(cache_control["max-age"])
+        try:
+            if "Expires" in self.headers:
+                return parsedate_to_datetime(self.headers["Expires"]).timestamp() - self.stored_at
+            if "Last-Modified" in self.headers:
+                # heuristic freshness, a tenth of the time since the last modification
+                modified = parsedate_to_datetime(self.headers["Last-Modified"]).timestamp()
+                return max(0, self.stored_at - modified) / 10
+        except (TypeError, ValueError):
+            pass
+        return 0
+
+    def is_fresh(self):
+        # ------------------------------------------------------------------------------------------
+        return time.time() - self.stored_at < self.freshness_lifetime()
+
+    def validators(self):
+        # ------------------------------------------------------------------------------------------
+        """
+        Headers of a conditional request revalidating this entry
+        """
+        headers = {}
+        if "ETag" in self.headers:
+            headers["If-None-Match"] = self.headers["ETag"]
+        if "Last-Modified" in self.headers:
+            headers["If-Modified-Since"] = self.headers["Last-Modified"]
+        return headers
+
+
+class DiskCache:
+    # ----------------------------------------------------------------------------------------------
+    """
+    Downloaded content kept in directory, one .json file of response headers and
+    one .bin file of content per url
+    """
+
+    HEADERS = ("Cache-Control", "Expires", "ETag", "Last-Modified")
+
+    def __init__(self, directory):
+        # ------------------------------------------------------------------------------------------
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url):
+        # ------------------------------------------------------------------------------------------
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest())
+
+    def load(self, url):
+        # ------------------------------------------------------------------------------------------
+        path = self._path(url)
+        try:
+            with open(path + ".json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["url"] != url:
+                return None
+            with open(path + ".bin", "rb") as f:
+                content = f.read()
+        except (OSError, ValueError, KeyError):
+            return None
+        return DiskCacheEntry(meta["headers"], content, meta["stored_at"])
+
+    def store(self, url, headers, content):
+        # ------------------------------------------------------------------------------------------
+        headers = {k: headers[k] for k in self.HEADERS if k in headers}
+        if not DiskCacheEntry(headers, content, time.time()).storable():
+            return
+
+        path = self._path(url)
+        meta = {"url": url, "headers": headers, "stored_at": time.time()}
+        try:
+            # write to temporary files first so readers never see a partial entry
+            with open(path + ".bin.tmp", "wb") as f:
+                f.write(content)
+            with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(path + ".bin.tmp", path + ".bin")
+            os.replace(path + ".json.tmp", path + ".json")
+        except OSError:
+            pass
+
+
+# shared by every parser unless one is given its own cache
+image_cache = ImageCache()
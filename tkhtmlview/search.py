@@ -0,0 +1,155 @@
+"""
+Search in the text of a rendered document
+"""
+import re
+from bisect import bisect_right
+
+
+# __________________________________________________________________________________________________
+# classes
+class SearchIndex:
+    # ----------------------------------------------------------------------------------------------
+    """
+    Plain text of a rendered document, with the offsets of its lines, so the
+    matches of a query are found with str.find and their offsets converted to text
+    widget indices by bisection. Images are not part of the text. The text is
+    appended as it is rendered, and the matches of the last query are extended to
+    the appended text, or narrowed down when the query is extended, instead of
+    being searched again.
+    """
+
+    def __init__(self):
+        # ------------------------------------------------------------------------------------------
+        self.clear()
+
+    def __len__(self):
+        # ------------------------------------------------------------------------------------------
+        return self._length
+
+    def clear(self):
+        # ------------------------------------------------------------------------------------------
+        self._text = ""
+        self._chunks = []
+        self._length = 0
+        # lowercased self._text, None once lowercasing changes the length of the text
+        self._folded = ""
+        # offsets of the lines of self._text[:self._lines_end]
+        self._line_starts = [0]
+        self._lines_end = 0
+        # (query, nocase, searched text length, offsets) of the last find
+        self._last = None
+
+    @property
+    def text(self):
+        # ------------------------------------------------------------------------------------------
+        if self._chunks:
+            self._text += "".join(self._chunks)
+            self._chunks = []
+        return self._text
+
+    def append(self, text):
+        # ------------------------------------------------------------------------------------------
+        if text:
+            self._chunks.append(text)
+            self._length += len(text)
+
+    def truncate(self, length):
+        # ------------------------------------------------------------------------------------------
+        """
+        Remove the text after length
+        """
+        if length >= self._length:
+            return
+        self._text = self.text[:length]
+        self._length = length
+        if self._folded is not None:
+            self._folded = self._folded[:length]
+        if self._lines_end > length:
+            del self._line_starts[bisect_right(self._line_starts, length) :]
+            self._lines_end = length
+        if self._last is not None:
+            query, nocase, searched, offsets = self._last
+            end = length - len(query)
+            self._last = (query, nocase, min(searched, length), [o for o in offsets if o <= end])
+
+    def _text_folded(self):
+        # ------------------------------------------------------------------------------------------
+        text = self.text
+        if self._folded is not None and len(self._folded) < len(text):
+            folded = text[len(self._folded) :].lower()
+            if len(folded) == len(text) - len(self._folded):
+                self._folded += folded
+            else:
+                self._folded = None
+        return self._folded
+
+    def find(self, query, nocase=True):
+        # ------------------------------------------------------------------------------------------
+        """
+        Offsets in the text of the matches of query, in order. The result is shared,
+        it must not be modified.
+        """
+        if not query:
+            return []
+        text = self._text_folded() if nocase else self.text
+        if text is None:
+            # some characters lowercase to several, match them one by one instead
+            pattern = re.compile(f"(?={re.escape(query)})", re.IGNORECASE)
+            return [match.start() for match in pattern.finditer(self.text)]
+        if nocase:
+            query = query.lower()
+
+        last = self._last
+        if last is not None and last[1] == nocase and query.startswith(last[0]):
+            last_query, _, searched, offsets = last
+            if searched == len(text) and last_query == query:
+                return offsets
+            if last_query != query:
+                offsets = [o for o in offsets if text.startswith(query, o)]
+            else:
+                offsets = list(offsets)
+            # the offsets before start were searched for the last query
+            start = max(searched - len(last_query) + 1, 0)
+        else:
+            offsets, start = [], 0
+
+        offset = text.find(query, start)
+        while offset >= 0:
+            offsets.append(offset)
+            offset = text.find(query, offset + 1)
+        self._last = (query, nocase, len(text), offsets)
+        return offsets
+
+    def _lines_update(self):
+        # ------------------------------------------------------------------------------------------
+        text = self.text
+        offset = text.find("\n", self._lines_end)
+        while offset >= 0:
+            self._line_starts.append(offset + 1)
+            offset = text.find("\n", offset + 1)
+        self._lines_end = len(text)
+
+    def lines(self):
+        # ------------------------------------------------------------------------------------------
+        self._lines_update()
+        return len(self._line_starts)
+
+    def line_offset(self, line):
+        # ------------------------------------------------------------------------------------------
+        """
+        Offset of the start of line, counted from 1, the length of the text after
+        the last line
+        """
+        self._lines_update()
+        if line > len(self._line_starts):
+            return self._length
+        return self._line_starts[max(line, 1) - 1]
+
+    def line_column(self, offset):
+        # ------------------------------------------------------------------------------------------
+        """
+        (line, column) of offset, the line counted from 1
+        """
+        self._lines_update()
+        line = bisect_right(self._line_starts, offset)
+        return line, offset - self._line_starts[line - 1]
@@ -0,0 +1,345 @@
+"""
+Virtual scrolling, for documents too big to be inserted whole in a text widget
+"""
+import math
+import tkinter as tk
+from tkhtmlview.html_parser import Defs, Run
+
+
+# __________________________________________________________________________________________________
+# classes
+class HeightIndex:
+    # ----------------------------------------------------------------------------------------------
+    """
+    Heights in pixels of the blocks of a document, as a Fenwick tree, so a height
+    is changed, the offset of a block computed and the block at an offset found
+    in O(log n)
+    """
+
+    def __init__(self, heights):
+        # ------------------------------------------------------------------------------------------
+        self.heights = list(heights)
+        tree = [0] + self.heights
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+        self.total = sum(self.heights)
+
+    def __len__(self):
+        # ------------------------------------------------------------------------------------------
+        return len(self.heights)
+
+    def append(self, height):
+        # ------------------------------------------------------------------------------------------
+        # the new node covers the heights since the start of the range of its lowest bit
+        i = len(self.heights) + 1
+        self.heights.append(height)
+        self._tree.append(height + self.offset(i - 1) - self.offset(i - (i & -i)))
+        self.total += height
+
+    def truncate(self, count):
+        # ------------------------------------------------------------------------------------------
+        # the nodes of the first count heights do not cover the ones after them
+        self.total -= sum(self.heights[count:])
+        del self.heights[count:]
+        del self._tree[count + 1 :]
+
+    def set(self, index, height):
+        # ------------------------------------------------------------------------------------------
+        delta = height - self.heights[index]
+        if not delta:
+            return
+        self.heights[index] = height
+        self.total += delta
+        i = index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def offset(self, index):
+        # ------------------------------------------------------------------------------------------
+        """
+        Offset of the block index, the sum of the heights of the blocks before it
+        """
+        offset = 0
+        while index > 0:
+            offset += self._tree[index]
+            index -= index & -index
+        return offset
+
+    def find(self, y):
+        # ------------------------------------------------------------------------------------------
+        """
+        Index of the block at the offset y
+        """
+        index = 0
+        step = 1 << len(self.heights).bit_length()
+        while step:
+            i = index + step
+            if i < len(self._tree) and self._tree[i] <= y:
+                index = i
+                y -= self._tree[i]
+            step >>= 1
+        return min(index, len(self.heights) - 1)
+
+
+class VirtualView:
+    # ----------------------------------------------------------------------------------------------
+    """
+    Keeps the blocks of a parsed document, one per line of text, and renders in
+    the scrolled text widget w only the blocks around its viewport. The other
+    blocks are removed from w with their images as the viewport moves. The
+    scrollbar is driven by the estimated heights of the blocks, replaced by
+    their measured heights once they have been rendered.
+    """
+
+    def __init__(self, w, parser, blocks):
+        # ------------------------------------------------------------------------------------------
+        self.w = w
+        self.parser = parser
+        self.blocks = []
+        # blocks[first:last] are rendered, block first on line 1
+        self.first = self.last = 0
+        self._metrics = {}
+        self._width = None
+        self._update_job = None
+        # the commands are owned by the render, and the previous ones given back on close
+        self._yscrollcommand = w.cget("yscrollcommand")
+        self._vbarcommand = w.vbar.cget("command")
+        w.config(yscrollcommand=parser.w_resources.register(w, self._on_yscroll))
+        w.vbar.config(command=parser.w_resources.register(w, self.yview))
+        self.set_blocks(blocks)
+
+    def close(self):
+        # ------------------------------------------------------------------------------------------
+        """
+        Give the scrollbar back to the widget, which keeps the rendered blocks
+        """
+        if self._update_job is not None:
+            self.w.after_cancel(self._update_job)
+            self._update_job = None
+        self.w.config(yscrollcommand=self._yscrollcommand)
+        self.w.vbar.config(command=self._vbarcommand)
+
+    def set_blocks(self, blocks):
+        # ------------------------------------------------------------------------------------------
+        """
+        Replace the document, keeping the viewport on the same block
+        """
+        block, offset = self._top() if self.first < self.last else (0, 0)
+        self.blocks = blocks
+        self._estimate()
+        self._render(min(block, len(blocks) - 1), offset, force=True)
+
+    def extend_blocks(self, first, blocks):
+        # ------------------------------------------------------------------------------------------
+        """
+        Replace the blocks from first on, as appended to the document. The heights
+        of the blocks before first are kept, and only the rendered blocks from first
+        on are rendered again.
+        """
+        self.blocks[first:] = blocks
+        self.heights.truncate(first)
+        for block in blocks:
+            self.heights.append(self._estimate_height(block))
+        if first <= self.first:
+            block, offset = self._top() if self.first < self.last else (0, 0)
+            self._render(min(block, len(self.blocks) - 1), offset, force=True)
+        elif first < self.last:
+            w = self.w
+            prev_state = w.cget("state")
+            w.config(state=tk.NORMAL)
+            self.parser.w_virtual_delete(w, f"{first - self.first + 1}.0", tk.END)
+            w.config(state=prev_state)
+            self.last = first
+        # the window is extended over the new blocks once idle, if they are near the view
+        self._on_yscroll()
+
+    # ----------------------------------------------------------------------------------------------
+    # heights
+
+    def _view_size(self):
+        # ------------------------------------------------------------------------------------------
+        if self.w.winfo_ismapped():
+            return self.w.winfo_width(), self.w.winfo_height()
+        return self.w.winfo_reqwidth(), self.w.winfo_reqheight()
+
+    def _font_metrics(self, key):
+        # ------------------------------------------------------------------------------------------
+        metrics = self._metrics.get(key)
+        if metrics is None:
+            font = self.parser.w_font(self.w, key)
+            metrics = self._metrics[key] = (font.metrics("linespace"), font.measure("0"))
+        return metrics
+
+    def _estimate_height(self, block):
+        # ------------------------------------------------------------------------------------------
+        line_height, width = 1, 0
+        for kind, value, key in block:
+            if kind == Run.IMAGE:
+                _, image_width, image_height = value
+                line_height = max(line_height, image_height or Defs.IMAGE_PLACEHOLDER_SIZE[1])
+                width += image_width or Defs.IMAGE_PLACEHOLDER_SIZE[0]
+            else:
+                linespace, char_width = self._font_metrics(key)
+                line_height = max(line_height, linespace)
+                width += len(value) * char_width
+        return line_height * max(1, math.ceil(width / self._width))
+
+    def _estimate(self):
+        # ------------------------------------------------------------------------------------------
+        self._width = max(self._view_size()[0], 1)
+        self.heights = HeightIndex(self._estimate_height(block) for block in self.blocks)
+
+    def _measure(self, start, end):
+        # ------------------------------------------------------------------------------------------
+        """
+        Replace the estimated heights of the rendered blocks[start:end]
+        """
+        if not self.w.winfo_ismapped():
+            return
+        for i in range(start, end):
+            line = i - self.first + 1
+            height = self._ypixels(f"{line}.0", f"{line + 1}.0")
+            if height:
+                self.heights.set(i, height)
+
+    def _ypixels(self, index1, index2):
+        # ------------------------------------------------------------------------------------------
+        count = self.w.count(index1, index2, "update", "ypixels")
+        if isinstance(count, tuple):
+            count = count[0]
+        return count or 0
+
+    # ----------------------------------------------------------------------------------------------
+    # viewport
+
+    def _top(self):
+        # ------------------------------------------------------------------------------------------
+        """
+        (block, pixels of the block above the viewport) of the top of the viewport
+        """
+        index = self.w.index("@0,0")
+        line = int(index.split(".")[0])
+        offset = self._ypixels(f"{line}.0", index)
+        info = self.w.dlineinfo(index)
+        if info:
+            inset = sum(
+                int(str(self.w.cget(option)))
+                for option in ("borderwidth", "highlightthickness", "pady")
+            )
+            offset += max(0, inset - info[1])
+        return min(self.first + line - 1, self.last - 1), offset
+
+    def _window(self, y, view_height):
+        # ------------------------------------------------------------------------------------------
+        margin = Defs.VIRTUAL_MARGIN * view_height
+        first = self.heights.find(max(0, y - margin))
+        last = self.heights.find(y + view_height + margin) + 1
+        return first, last
+
+    def _render(self, block, offset, force=False):
+        # ------------------------------------------------------------------------------------------
+        """
+        Render the blocks around the viewport, with offset pixels of block above it
+        """
+        w = self.w
+        view_height = self._view_size()[1]
+        first, last = (
+            self._window(self.heights.offset(block) + offset, view_height)
+            if self.blocks
+            else (0, 0)
+        )
+        if force or (first, last) != (self.first, self.last):
+            self._render_window(first, last, force)
+        if self.blocks:
+            w.yview(f"{block - first + 1}.0")
+            if offset:
+                w.yview_scroll(offset, "pixels")
+
+    def _render_window(self, first, last, force):
+        # ------------------------------------------------------------------------------------------
+        w, parser = self.w, self.parser
+        prev_state = w.cget("state")
+        w.config(state=tk.NORMAL)
+        if force or first >= self.last or last <= self.first:
+            parser.w_virtual_delete(w, "1.0", tk.END)
+            parser.w_virtual_insert(w, self.blocks[first:last])
+            added = ((first, last),)
+        else:
+            # from the end, so the line numbers of the blocks before stay valid
+            added = []
+            if last < self.last:
+                parser.w_virtual_delete(w, f"{last - self.first + 1}.0", tk.END)
+            elif last > self.last:
+                parser.w_virtual_insert(w, self.blocks[self.last : last])
+                added.append((self.last, last))
+            if first > self.first:
+                parser.w_virtual_delete(w, "1.0", f"{first - self.first + 1}.0")
+            elif first < self.first:
+                parser.w_virtual_insert(w, self.blocks[first : self.first], "1.0")
+                added.append((first, self.first))
+        w.config(state=prev_state)
+        self.first, self.last = first, last
+
+        for start, end in added:
+            self._measure(start, end)
+
+    def _update(self):
+        # ------------------------------------------------------------------------------------------
+        self._update_job = None
+        if not self.blocks:
+            self.w.vbar.set(0, 1)
+            return
+        width, view_height = self._view_size()
+        if max(width, 1) != self._width:
+            block, offset = self._top()
+            self._estimate()
+            self._render(block, offset, force=True)
+
+        block, offset = self._top()
+        y = self.heights.offset(block) + offset
+        margin = Defs.VIRTUAL_MARGIN * view_height / 2
+        if (self.first > 0 and y - self.heights.offset(self.first) < margin) or (
+            self.last < len(self.blocks)
+            and self.heights.offset(self.last) - y - view_height < margin
+        ):
+            self._render(block, offset)
+            block, offset = self._top()
+            y = self.heights.offset(block) + offset
+
+        total = max(self.heights.total, 1)
+        self.w.vbar.set(min(y / total, 1), min((y + view_height) / total, 1))
+        self.parser.w_search_show(self.w, self.first + 1)
+
+    def see(self, block):
+        # ------------------------------------------------------------------------------------------
+        """
+        Render the blocks around block unless it is rendered already
+        """
+        if self.blocks and not self.first <= block < self.last:
+            self._render(block, 0)
+            self._on_yscroll()
+
+    def _on_yscroll(self, *args):
+        # ------------------------------------------------------------------------------------------
+        # the view of the widget has changed, update the window and the scrollbar once idle
+        if self._update_job is None:
+            self._update_job = self.w.after_idle(self._update)
+
+    def yview(self, *args):
+        # ------------------------------------------------------------------------------------------
+        """
+        Scrollbar command, moveto positions are fractions of the whole document
+        """
+        if args and args[0] == tk.MOVETO and self.blocks:
+            view_height = self._view_size()[1]
+            y = float(args[1]) * self.heights.total
+            y = max(0, min(y, self.heights.total - view_height))
+            block = self.heights.find(y)
+            self._render(block, int(y - self.heights.offset(block)))
+            self._on_yscroll()
+        else:
+            self.w.yview(*args)